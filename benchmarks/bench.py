@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""Codec and protocol benchmarks
+
+Usage::
+
+    python benchmarks/bench.py [-k filter] [--save FILE] [--compare FILE] [--e2e]
+
+Reports ops/s and latency percentiles over individually timed calls.
+Burst cases divide each call time by the number of PDUs it handles.
+``--save`` stores results as a JSON baseline, ``--compare`` prints the
+ops/s change against one, e.g. the committed ``benchmarks/baseline.json``.
+End-to-end cases live in bench_e2e.py and need Python 3.5+.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import subprocess
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from smpipi import command, gsm  # noqa: E402
+from smpipi.proto import Proto  # noqa: E402
+
+clock = getattr(time, 'perf_counter', time.time)
+
+SAMPLES = {
+    'system_id': 'smpipi', 'password': 'secret', 'system_type': 'bench',
+    'interface_version': 0x34, 'message_id': '0123456789abcdef',
+    'final_date': '170101000000000+', 'message_state': 2,
+    'service_type': 'CMT', 'source_addr_ton': 5, 'source_addr_npi': 0,
+    'source_addr': 'smpipi', 'dest_addr_ton': 1, 'dest_addr_npi': 1,
+    'destination_addr': '79001234567', 'registered_delivery': 1,
+    'short_message': 'Hello from smpipi benchmark',
+    'dest_address': [{'dest_flag': 1, 'dest_addr_ton': 1, 'dest_addr_npi': 1,
+                      'destination_addr': '7900123456' + str(i)} for i in range(8)]
+                    + [{'dest_flag': 2, 'dl_name': 'friends'}],
+    'unsuccess_sme': [{'dest_addr_ton': 1, 'dest_addr_npi': 1,
+                       'destination_addr': '7900123456' + str(i),
+                       'error_status_code': 0x45} for i in range(4)],
+}
+
+TLVS = {
+    'user_message_reference': 42, 'source_port': 2000, 'destination_port': 3000,
+    'sar_msg_ref_num': 513, 'sar_total_segments': 3, 'sar_segment_seqnum': 2,
+    'payload_type': 0, 'privacy_indicator': 1, 'language_indicator': 1,
+    'its_session_info': b'\x01\x02', 'callback_num': b'\x00\x01\x0179001234567',
+    'message_payload': b'x' * 300,
+}
+
+GSM_TEXT = u'Lorem ipsum dolor sit amet, consectetur adipiscing elit [{}] ' * 8
+UCS2_TEXT = (u'Съешь же ещё этих мягких французских '
+             u'булок, да выпей чаю. ') * 6
+
+
+def sample(cmd_type, **fields):
+    names = getattr(cmd_type, 'body', command.Packet).names
+    kwargs = {k: v for k, v in SAMPLES.items() if k in names}
+    kwargs['sequence_number'] = 1
+    kwargs.update(fields)
+    return cmd_type(**kwargs)
+
+
+def codec_cases():
+    cmds = [sample(c) for _, c in sorted(command.commands.items())]
+    cmds.append(sample(command.SubmitSM, **TLVS))
+    receipt = ('id:abc sub:001 dlvrd:001 submit date:1701010000 '
+               'done date:1701010001 stat:DELIVRD err:000 text:')
+    cmds.append(sample(command.DeliverSM, esm_class=4, receipted_message_id=b'abc',
+                       message_state=2, network_error_code=b'\x03\x00\x00',
+                       short_message=receipt))
+    for cmd in cmds:
+        name = type(cmd).__name__
+        if len(cmd) > len(sample(type(cmd))):
+            name += '+tlv'
+        payload = cmd.encode()
+        yield 'encode ' + name, 1, cmd.encode
+        yield 'decode ' + name, 1, lambda p=payload: command.Command.decode(p)
+        yield 'decode compact ' + name, 1, lambda p=payload: command.Command.decode(
+            p, compact=True)
+        yield 'decode lazy ' + name, 1, lambda p=payload: command.Command.decode(
+            p, True)
+
+
+def burst_cases(count=1000):
+    data = Proto().send_bytes(*[sample(command.DeliverSM, sequence_number=i)
+                                for i in range(count)])
+
+    def whole():
+        for _ in Proto().receive_bytes(data):
+            pass
+
+    def chunked(size=4096):
+        proto = Proto()
+        for pos in range(0, len(data), size):
+            for _ in proto.receive_bytes(data[pos:pos + size]):
+                pass
+
+    yield 'receive burst x{}'.format(count), count, whole
+    yield 'receive burst x{} 4k chunks'.format(count), count, chunked
+
+
+def gsm_cases():
+    yield 'make_parts gsm', 1, lambda: gsm.make_parts(GSM_TEXT)
+    yield 'make_parts gsm packed', 1, lambda: gsm.make_parts(GSM_TEXT, packed=True)
+    yield 'make_parts ucs2', 1, lambda: gsm.make_parts(UCS2_TEXT)
+
+
+def measure(func, ops, repeat, min_time=0.01):
+    """Returns per-op times of `repeat` rounds of individually timed calls"""
+    number = 1
+    while True:
+        start = clock()
+        for _ in range(number):
+            func()
+        if clock() - start >= min_time:
+            break
+        number *= 2
+
+    samples = []
+    for _ in range(repeat):
+        for _ in range(number):
+            start = clock()
+            func()
+            samples.append((clock() - start) / ops)
+    return samples
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+
+def summary(samples):
+    return {
+        'ops': len(samples) / sum(samples),
+        'p50': percentile(samples, 50) * 1e6,
+        'p90': percentile(samples, 90) * 1e6,
+        'p99': percentile(samples, 99) * 1e6,
+    }
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+SERVER = '''
+import sys
+from tornado.ioloop import IOLoop
+from smpipi.tornado import Server, TestSMSC
+ioloop = IOLoop.current()
+Server(ioloop, TestSMSC).listen(int(sys.argv[1]), '127.0.0.1')
+ioloop.start()
+'''
+
+
+def e2e_results(count):
+    """Submits against tornado.TestSMSC running in a subprocess"""
+    import asyncio
+    from bench_e2e import submit_timings
+
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    server = subprocess.Popen([sys.executable, '-c', SERVER, str(port)], env=env)
+    try:
+        latency, elapsed = asyncio.get_event_loop().run_until_complete(
+            submit_timings(port, count))
+    finally:
+        server.kill()
+
+    results = OrderedDict([('e2e submit latency', summary(latency))])
+    for window, seconds in elapsed:
+        results['e2e submit window={}'.format(window)] = {
+            'ops': count / seconds, 'p50': None, 'p90': None, 'p99': None}
+    return results
+
+
+def fmt(value):
+    return '{:10.2f}'.format(value) if value is not None else '{:>10}'.format('-')
+
+
+def report(results, baseline=None):
+    print('{:<40} {:>12} {:>10} {:>10} {:>10} {:>8}'.format(
+        'benchmark', 'ops/s', 'p50 us', 'p90 us', 'p99 us', 'change'))
+    for name, r in results.items():
+        change = ''
+        if baseline and name in baseline:
+            change = '{:+.1f}%'.format((r['ops'] / baseline[name]['ops'] - 1) * 100)
+        print('{:<40} {:12.0f} {} {} {} {:>8}'.format(
+            name, r['ops'], fmt(r['p50']), fmt(r['p90']), fmt(r['p99']), change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='smpipi benchmarks')
+    parser.add_argument('-k', dest='filter',
+                        help='run benchmarks containing substring')
+    parser.add_argument('-r', '--repeat', type=int, default=20)
+    parser.add_argument('--save', help='store results as JSON baseline')
+    parser.add_argument('--compare', help='compare with JSON baseline')
+    parser.add_argument('--e2e', action='store_true',
+                        help='run end-to-end submits against tornado.TestSMSC')
+    parser.add_argument('--e2e-count', type=int, default=5000)
+    args = parser.parse_args()
+    if args.e2e and sys.version_info < (3, 5):
+        parser.error('--e2e needs Python 3.5+')
+
+    results = OrderedDict()
+    for cases in (codec_cases(), burst_cases(), gsm_cases()):
+        for name, ops, func in cases:
+            if not args.filter or args.filter in name:
+                results[name] = summary(measure(func, ops, args.repeat))
+
+    if args.e2e:
+        results.update(e2e_results(args.e2e_count))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    report(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'implementation': platform.python_implementation(),
+                       'time': time.time(),
+                       'results': results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
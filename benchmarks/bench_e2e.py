@@ -0,0 +1,32 @@
+"""End-to-end submit timings for bench.py, kept apart as it needs Python 3.5+"""
+import asyncio
+import time
+
+from smpipi.asyncio import ESME
+
+
+async def submit_timings(port, count, windows=(10, 100)):
+    """Returns per-submit latencies and elapsed time of `count` submits per window"""
+    esme = ESME()
+    for _ in range(50):
+        try:
+            await esme.connect('127.0.0.1', port)
+            break
+        except OSError:
+            await asyncio.sleep(0.1)
+    await esme.bind('bench', 'bench')
+
+    latency = []
+    for _ in range(min(count, 1000)):
+        start = time.perf_counter()
+        await esme.submit(short_message='boo')
+        latency.append(time.perf_counter() - start)
+
+    elapsed = []
+    for window in windows:
+        start = time.perf_counter()
+        await esme.submit_many([{'short_message': 'boo'}] * count, window)
+        elapsed.append((window, time.perf_counter() - start))
+
+    await esme.wait_for(esme.unbind())
+    return latency, elapsed
@@ -1,49 +1,521 @@
 import asyncio
+import inspect
+import logging
+from collections import deque
 
-from .proto import BaseESME
+from . import command
+from .compat import bytestr
+from .proto import (BaseConnection, BaseESME, BasePool, CommandError, PDUError,
+                    ReceiveBuffer, throttled_commands)
 
+log = logging.getLogger('smpipi.server')
+
+Protocol = getattr(asyncio, 'BufferedProtocol', asyncio.Protocol)
+
+
+class SubmitStream(object):
+    """Async iterator over (request, response) pairs in completion order
+
+    `messages` is a regular or an asynchronous iterable of SubmitSM
+    commands or their field dicts. At most `window` submits are in flight.
+    """
+    def __init__(self, esme, messages, window=10):
+        self.esme = esme
+        self.window = window
+        self.is_async = hasattr(messages, '__aiter__')
+        self.messages = messages.__aiter__() if self.is_async else iter(messages)
+        self.exhausted = False
+        self.in_flight = 0
+        self.fetch = None
+        self.wakeup = None
+        self.results = deque()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.results:
+            if self.esme.closed or (self.exhausted and not self.in_flight):
+                self.fetch and self.fetch.cancel()
+                raise StopAsyncIteration
+
+            await self.esme.drain()
+            self._fill()
+            if self.results:
+                break
+
+            self.wakeup = self.esme._future()
+            waiters = [self.wakeup] + ([self.fetch] if self.fetch else [])
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            self.wakeup.done() or self.wakeup.cancel()
+            if self.fetch and self.fetch.done():
+                self._fetched()
+
+        return self.results.popleft()
+
+    def _fill(self):
+        cmds = []
+        while not self.exhausted and self.in_flight + len(cmds) < self.window:
+            if self.is_async:
+                if self.fetch is None:
+                    self.fetch = asyncio.ensure_future(self.messages.__anext__())
+                break
+            try:
+                cmds.append(next(self.messages))
+            except StopIteration:
+                self.exhausted = True
+        self._send(cmds)
+
+    def _fetched(self):
+        fetch, self.fetch = self.fetch, None
+        try:
+            msg = fetch.result()
+        except StopAsyncIteration:
+            self.exhausted = True
+        else:
+            self._send([msg])
+
+    def _send(self, messages):
+        cmds = [msg if isinstance(msg, command.Command) else command.SubmitSM(**msg)
+                for msg in messages]
+        if cmds:
+            self.in_flight += len(cmds)
+            self.esme.send_many(cmds, self._resolved, self._resolved)
+
+    def _resolved(self, resp):
+        self.in_flight -= 1
+        self.results.append((resp.request, resp.response if resp.ready else None))
+        self.wakeup and not self.wakeup.done() and self.wakeup.set_result(None)
+
+
+class ESME(BaseESME, Protocol):
+    tick_interval = 1
 
-class ESME(BaseESME):
     def __init__(self, **kwargs):
         BaseESME.__init__(self, **kwargs)
+        self.loop = None
+        self.transport = None
         self.closed = False
-        self.running = False
+        self.done = None
+        self._drain = None
+        self._stalled = []
+        self._waiters = set()
+        self._release_timer = None
+
+    async def connect(self, host, port, **kwargs):
+        self.loop = asyncio.get_event_loop()
+        self.done = self.loop.create_future()
+        await self.loop.create_connection(lambda: self, host, port, **kwargs)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop.call_later(self.tick_interval, self._tick)
+
+    def data_received(self, data):  # pragma: no cover
+        self.feed(data)
+
+    def get_buffer(self, sizehint):
+        return self.receiver.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.feed(self.receiver.received(nbytes))
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.resume_writing()
+        for future in list(self._waiters):
+            future.done() or future.set_result(None)
+        self.done.done() or self.done.set_result(None)
+
+    def pause_writing(self):
+        if self._drain is None:
+            self._drain = self.loop.create_future()
 
-    @asyncio.coroutine
-    def connect(self, host, port):
-        self.reader, self.writer = yield from asyncio.open_connection(host, port)
+    def resume_writing(self):
+        if self._drain is not None:
+            self._drain.done() or self._drain.set_result(None)
+            self._drain = None
+
+        stalled, self._stalled = self._stalled, []
+        if not self.closed:
+            for pipeline in stalled:
+                pipeline.fill()
+
+    def defer_fill(self, pipeline):
+        if self._drain is None:
+            return False
+        pipeline in self._stalled or self._stalled.append(pipeline)
+        return True
+
+    async def drain(self):
+        """Waits until the transport write buffer drops below low water mark"""
+        if self._drain is not None:
+            await self._drain
+
+    def _tick(self):
+        if not self.closed:
+            self.expire_requests()
+            self.loop.call_later(self.tick_interval, self._tick)
 
     def on_send(self, data):
-        self.writer.write(data)
+        self.transport.write(data)
 
     def on_close(self):
         self.closed = True
-        self.writer.close()
+        self.transport.close()
+
+    def on_throttle(self, delay):
+        if self._release_timer is None:
+            self._release_timer = self.loop.call_later(delay, self._release)
+
+    def _release(self):
+        self._release_timer = None
+        if not self.closed:
+            self.release()
 
     def _deliver(self, req, resp):
         reply = self._make_reply(resp)
         future = asyncio.ensure_future(self.on_deliver(req, resp, reply))
-        future.add_done_callback(lambda _: reply.called or reply())
+        future.add_done_callback(lambda f: self._delivered(req, reply, f))
+
+    def _future(self):
+        future = self.loop.create_future()
+        if self.closed:
+            future.set_result(None)
+        else:
+            self._waiters.add(future)
+            future.add_done_callback(self._waiters.discard)
+        return future
 
     def wait_for(self, response):
-        if self.running:
-            future = asyncio.Future()
-            response.callback = lambda resp: future.set_result(resp.response)
-            return future
+        future = self._future()
+        if response.ready:
+            future.done() or future.set_result(response.response)
         else:
-            return self.run(response)
+            response.callback = lambda resp: future.done() or future.set_result(resp.response)
+            response.on_timeout = lambda resp: future.done() or future.set_result(None)
+        return future
+
+    async def run(self, response=None):
+        if response:
+            return await self.wait_for(response)
+        await self.done
+
+    async def request(self, cmd):
+        response = self.send(cmd)
+        await self.drain()
+        return await self.wait_for(response)
+
+    async def bind(self, system_id, password, mode='transceiver', **kwargs):
+        response = getattr(self, 'bind_' + mode)(system_id, password, **kwargs)
+        return await self.wait_for(response)
+
+    async def submit(self, **kwargs):
+        response = self.send_message(**kwargs)
+        await self.drain()
+        return await self.wait_for(response)
+
+    async def submit_many(self, messages, window=10):
+        """Returns (request, response) pairs for submitted messages"""
+        wakeup = [None]
+
+        def resolved(req, resp):
+            wakeup[0] and not wakeup[0].done() and wakeup[0].set_result(None)
+
+        pipeline = self.pipeline(messages, window, resolved)
+        while not pipeline.done and not self.closed:
+            wakeup[0] = self._future()
+            await wakeup[0]
+            await self.drain()
+
+        return list(pipeline.results)
+
+    def submit_iter(self, messages, window=10):
+        """Returns async iterator yielding (request, response) pairs as they resolve
+
+        Unlike `submit_many` also accepts asynchronous iterables of messages.
+        """
+        return SubmitStream(self, messages, window)
+
+
+class ESMEPool(BasePool):
+    def __init__(self, host, port, system_id, password, size=2, mode='transceiver',
+                 window=10, reconnect_delay=5, **kwargs):
+        BasePool.__init__(self, window)
+        self.address = (host, port)
+        self.credentials = (system_id, password, mode)
+        self.size = size
+        self.reconnect_delay = reconnect_delay
+        self.kwargs = kwargs
+        self.stopped = False
+        self.tasks = []
+        self._slot = None
+
+    def start(self):
+        self.stopped = False
+        self.tasks = [asyncio.ensure_future(self._keep()) for _ in range(self.size)]
+
+    async def stop(self):
+        self.stopped = True
+        for esme in list(self.connections):
+            await esme.wait_for(esme.unbind())
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self._wake()
+
+    async def _keep(self):
+        system_id, password, mode = self.credentials
+        while not self.stopped:
+            esme = ESME(**self.kwargs)
+            try:
+                await esme.connect(*self.address)
+                resp = await esme.bind(system_id, password, mode)
+                if resp and resp.command_status == 0:
+                    self.add(esme)
+                    await esme.run()
+            except OSError:
+                pass
+            finally:
+                self.remove(esme)
+                if esme.transport and not esme.closed:
+                    esme.on_close()
+
+            if not self.stopped:
+                await asyncio.sleep(self.reconnect_delay)
+
+    def _wake(self):
+        if self._slot is not None and not self._slot.done():
+            self._slot.set_result(None)
+
+    async def wait_slot(self):
+        """Waits until some bind gets a free window slot"""
+        while not self.stopped and not self.pick():
+            if self._slot is None or self._slot.done():
+                self._slot = asyncio.get_event_loop().create_future()
+            await self._slot
+
+    async def submit(self, **kwargs):
+        await self.wait_slot()
+        esme = self.pick()
+        if esme is None:
+            return None
 
-    @asyncio.coroutine
-    def run(self, response=None):
-        self.running = True
         try:
-            while not self.closed and (not response or not response.ready):
-                data = yield from self.reader.read(1024)
-                if not data:
-                    break
-                self.feed(data)
+            return await esme.submit(**kwargs)
         finally:
-            self.running = False
+            self._wake()
+
+    async def on_deliver(self, req, resp, reply):  # pragma: no cover
+        pass
+
+
+bind_modes = {
+    command.BindTransmitter: 'transmitter',
+    command.BindReceiver: 'receiver',
+    command.BindTransceiver: 'transceiver',
+}
+
+
+class Session(BaseConnection, Protocol):
+    """SMSC side of an ESME connection"""
+    def __init__(self, server, **kwargs):
+        BaseConnection.__init__(self, **kwargs)
+        # feed() copies data out right away, so sessions share the server buffer
+        self.receiver = server.receiver
+        self.server = server
+        self.transport = None
+        self.closed = False
+        self.binding = False
+        self.mode = None
+        self.system_id = None
+        self.window = server.window
+        self.pending = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.sessions.add(self)
+
+    def data_received(self, data):  # pragma: no cover
+        self.feed(data)
+
+    def get_buffer(self, sizehint):
+        return self.receiver.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.feed(self.receiver.received(nbytes))
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.server.remove(self)
+
+    def on_send(self, data):
+        self.closed or self.transport.write(data)
+
+    def on_close(self):
+        self.closed = True
+        self.transport.close()
+
+    def handle(self, cmd):
+        if type(cmd) is PDUError:
+            return self.on_pdu_error(cmd)
+
+        cmd_type = command.command_from_data(cmd)
+        if cmd_type.is_response or cmd_type is command.EnquireLink or cmd_type is command.Unbind:
+            BaseConnection.handle(self, cmd)
+        elif cmd_type in bind_modes:
+            if self.mode or self.binding:
+                self._reject(cmd, cmd_type, command.ESME_RALYBND)
+            else:
+                self.binding = True
+                self._call(self.server.authenticate, cmd, self._bound)
+        elif not self.mode or self.mode == 'receiver' and cmd_type in throttled_commands:
+            self._reject(cmd, cmd_type, command.ESME_RINVBNDSTS)
+        elif cmd_type in throttled_commands:
+            if self.pending >= self.window:
+                self._reject(cmd, cmd_type, command.ESME_RTHROTTLED)
+            else:
+                self.pending += 1
+                self._call(self.server.on_submit, cmd, self._submitted)
+        else:
+            self._call(self.server.on_request, cmd, self._replied)
+
+    def _reject(self, cmd, cmd_type, status):
+        resp = getattr(cmd_type, 'response', command.GenericNack)
+        self.reply(resp(command_status=status, sequence_number=cmd.sequence_number))
+
+    def _call(self, handler, cmd, done):
+        """Runs sync or async `handler`, passes its result or error to `done`"""
+        try:
+            result = handler(self, cmd)
+        except Exception as e:
+            return done(cmd, None, e)
+
+        if not inspect.isawaitable(result):
+            return done(cmd, result, None)
+
+        def finished(future):
+            error = future.cancelled() and CommandError(command.ESME_RSYSERR) or future.exception()
+            done(cmd, None if error else future.result(), error)
+        asyncio.ensure_future(result).add_done_callback(finished)
+
+    def _status(self, error):
+        if not isinstance(error, CommandError):
+            log.error('Request handler failed', exc_info=error)
+        return getattr(error, 'command_status', command.ESME_RSYSERR)
+
+    def _bound(self, cmd, status, error):
+        self.binding = False
+        if error:
+            status = self._status(error)
+        elif status is None:
+            status = command.ESME_RBINDFAIL
+
+        cmd_type = command.command_from_data(cmd)
+        if not status and not self.closed:
+            self.mode = bind_modes[cmd_type]
+            self.system_id = cmd.system_id
+            self.server.add(self)
+        self.reply(cmd_type.response(system_id=self.server.system_id, command_status=status,
+                                     sequence_number=cmd.sequence_number))
+
+    def _submitted(self, cmd, message_id, error):
+        self.pending -= 1
+        status = error and self._status(error) or command.ESME_ROK
+        resp = command.command_from_data(cmd).response
+        self.reply(resp(message_id=None if status else message_id, command_status=status,
+                        sequence_number=cmd.sequence_number))
+
+    def _replied(self, cmd, resp, error):
+        if resp is None:
+            self._reject(cmd, command.command_from_data(cmd),
+                         self._status(error) if error else command.ESME_RINVCMDID)
+        else:
+            resp.sequence_number = cmd.sequence_number
+            self.reply(resp)
+
+    @property
+    def can_receive(self):
+        return self.mode in ('receiver', 'transceiver') and not self.closed
+
+    def deliver(self, callback=None, **fields):
+        """Sends deliver_sm, returns Response"""
+        return self.send(command.DeliverSM(**fields), callback)
+
+    def deliver_many(self, messages, callback=None):
+        """Sends deliver_sm for each fields dict in one write"""
+        with self.batch():
+            return self.send_many([command.DeliverSM(**m) for m in messages], callback)
+
+
+class Server(object):
+    """asyncio SMSC accepting ESME binds
+
+    Override `authenticate`, `on_submit` and `on_request`, they can be plain
+    functions or coroutines. Raise CommandError to reject a request.
+    """
+    session_class = Session
+
+    def __init__(self, system_id='smpipi', window=10, tick_interval=1, **kwargs):
+        self.system_id = system_id
+        self.window = window
+        self.tick_interval = tick_interval
+        self.kwargs = kwargs
+        self.receiver = ReceiveBuffer(kwargs.get('recv_size'), kwargs.get('recv_max_size'))
+        self.sessions = set()
+        self.bound = {}
+        self.server = None
+        self.loop = None
+        self.message_id = 0
+
+    async def start(self, host, port, **kwargs):
+        self.loop = asyncio.get_event_loop()
+        self.server = await self.loop.create_server(
+            lambda: self.session_class(self, **self.kwargs), host, port, **kwargs)
+        self.loop.call_later(self.tick_interval, self._tick)
+        return self.server
+
+    async def stop(self):
+        self.server.close()
+        for session in list(self.sessions):
+            session.closed or session._close()
+        await self.server.wait_closed()
+
+    def _tick(self):
+        if self.server.sockets:
+            for session in self.sessions:
+                session.in_flight and session.expire_requests()
+            self.loop.call_later(self.tick_interval, self._tick)
+
+    def add(self, session):
+        self.bound.setdefault(session.system_id, []).append(session)
+
+    def remove(self, session):
+        self.sessions.discard(session)
+        bound = self.bound.get(session.system_id)
+        if bound and session in bound:
+            bound.remove(session)
+            bound or self.bound.pop(session.system_id)
+
+    def pick(self, system_id):
+        """Returns least loaded receiving session bound as `system_id`"""
+        sessions = [s for s in self.bound.get(bytestr(system_id), ()) if s.can_receive]
+        return min(sessions, key=lambda s: len(s.in_flight)) if sessions else None
+
+    def deliver(self, system_id, callback=None, **fields):
+        """Sends deliver_sm to `system_id`, returns Response or None if it is not bound"""
+        session = self.pick(system_id)
+        return session and session.deliver(callback, **fields)
+
+    def authenticate(self, session, cmd):  # pragma: no cover
+        """Returns command_status for a bind request"""
+        return command.ESME_ROK
+
+    def on_submit(self, session, cmd):  # pragma: no cover
+        """Returns message_id for a submit request"""
+        self.message_id += 1
+        return '{:x}'.format(self.message_id)
 
-        if response and response.ready:
-            return response.response
+    def on_request(self, session, cmd):  # pragma: no cover
+        """Returns response command for other requests"""
+        return None
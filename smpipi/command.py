@@ -1,8 +1,23 @@
+from operator import itemgetter
+from struct import error as struct_error
+
 from . import tlv
 from .packet import (Packet, NString, int8, Field, Array, DispatchField,
-                     SizeField, int32, AttrDict, String)
+                     SizeField, int32, AttrDict, String, step_names, DecodeError)
 
 commands = {}
+compact_commands = {}
+
+ESME_ROK = 0x00000000
+ESME_RINVCMDLEN = 0x00000002
+ESME_RINVCMDID = 0x00000003
+ESME_RINVBNDSTS = 0x00000004
+ESME_RALYBND = 0x00000005
+ESME_RSYSERR = 0x00000008
+ESME_RBINDFAIL = 0x0000000D
+ESME_RTHROTTLED = 0x00000058
+ESME_RINVOPTPARSTREAM = tlv.ESME_RINVOPTPARSTREAM
+ESME_RINVPARLEN = tlv.ESME_RINVPARLEN
 
 
 class CommandMeta(type):
@@ -15,40 +30,405 @@ def command_from_data(data):
     return commands[data.command_id]
 
 
+def compact_from_id(command_id):
+    """Returns empty compact command, unpickling rebuilds them with it"""
+    return commands[command_id].compact_type()()
+
+
+def slot_filler(names):
+    """Compiles method assigning `names` slots from a decoded dict in one statement"""
+    namespace = {'values': itemgetter(*names)}
+    targets = ', '.join('self.' + name for name in names)
+    exec('def fill(self, data):\n    {} = values(data)\n'.format(targets), namespace)
+    return namespace['fill']
+
+
+def decode_body(body, ctx, buf, offset):
+    try:
+        offset = body.decode_into(ctx, buf, offset)
+    except DecodeError as e:
+        e.command_status = e.command_status or ESME_RINVCMDLEN
+        raise
+    except (struct_error, IndexError, KeyError) as e:
+        raise DecodeError('malformed {}: {!r}'.format(body.__name__, e), ESME_RINVCMDLEN)
+
+    if offset > len(buf):
+        raise DecodeError('{} exceeds command_length'.format(body.__name__), ESME_RINVCMDLEN)
+    return offset
+
+
 class Command(CommandMeta('CommandBase', (AttrDict,), {})):
     is_response = False
+    _pending = None
+    _template = None
+
     def __init__(self, **kwargs):
         self.update(kwargs)
         self['command_id'] = self.command_id
 
     def __repr__(self):  # pragma: no cover
-        return '{}({})'.format(self.__class__.__name__, dict(self))
+        return '{}({})'.format(self.__class__.__name__, dict.__repr__(self))
 
-    @staticmethod
-    def decode(buf):
-        size = len(buf)
-        result, offset = Header.decode(buf, 0)
-        cmd = command_from_data(result)
-        if offset < size and hasattr(cmd, 'body'):
-            body, offset = cmd.body.decode(buf, offset)
-            result.update(body)
+    def __missing__(self, key):
+        if isinstance(key, str) and key[:2] == '__':
+            # copy and pickle probe optional dunder attributes with getattr()
+            raise AttributeError(key)
+        if self._pending:
+            self.load()
+            return self[key]
+        raise KeyError(key)
+
+    def __reduce__(self):
+        # lazy and template state stays out of copies and pickles
+        self._pending and self.load()
+        return self.__class__, (), None, None, iter(dict.items(self))
+
+    # dict lookups bypassing __missing__ decode a lazy body first
+
+    def __contains__(self, key):
+        self._pending and self.load()
+        return dict.__contains__(self, key)
+
+    def __iter__(self):
+        self._pending and self.load()
+        return dict.__iter__(self)
 
-            opts, _ = tlv.decode(buf, offset)
-            result.update(opts)
+    def __len__(self):
+        self._pending and self.load()
+        return dict.__len__(self)
 
-        return cmd(**result)
+    def __eq__(self, other):
+        self._pending and self.load()
+        isinstance(other, Command) and other.load()
+        return dict.__eq__(self, other)
 
-    def encode(self):
-        body = b''
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def get(self, key, default=None):
+        self._pending and self.load()
+        return dict.get(self, key, default)
+
+    def keys(self):
+        self._pending and self.load()
+        return dict.keys(self)
+
+    def items(self):
+        self._pending and self.load()
+        return dict.items(self)
+
+    def values(self):
+        self._pending and self.load()
+        return dict.values(self)
+
+    @staticmethod
+    def decode(buf, lazy=False, compact=False, registry=None):
+        command_id, = int32.struct.unpack_from(buf, 4)
+        cmd_type = commands.get(command_id)
+        if cmd_type is None:
+            raise DecodeError('unknown command_id {:#x}'.format(command_id), ESME_RINVCMDID)
+        if compact:
+            cmd_type = cmd_type.compact_type()
+
+        cmd = cmd_type.__new__(cmd_type)
+        ctx = {} if compact else cmd
+        offset = Header.decode_into(ctx, buf, 0)
+        opts = None
+        if offset < len(buf) and hasattr(cmd_type, 'body'):
+            if lazy:
+                object.__setattr__(cmd, '_pending', (buf, offset, registry))
+            else:
+                offset = decode_body(cmd_type.body, ctx, buf, offset)
+                opts, _ = (registry or tlv.default).decode(buf, offset)
+
+        compact and cmd.fill(ctx)
+        opts and cmd.update(opts)
+        return cmd
+
+    def load(self):
+        """Decodes body and TLVs of a lazily decoded command"""
+        if self._pending:
+            buf, offset, registry = self._pending
+            object.__setattr__(self, '_pending', None)
+            body = AttrDict()
+            offset = decode_body(self.body, body, buf, offset)
+            for k, v in body.items():
+                self.setdefault(k, v)
+
+            opts, _ = (registry or tlv.default).decode(buf, offset)
+            for k, v in opts.items():
+                self.setdefault(k, v)
+        return self
+
+    def optional_params(self):
+        """Returns mapping holding TLV values"""
+        return self
+
+    @classmethod
+    def compact_type(cls):
+        """Returns slotted counterpart of the command class"""
+        compact = compact_commands.get(cls.command_id)
+        if compact is None:
+            names = tuple(n for n in Header.names if n != 'command_id')
+            names += getattr(cls, 'body', Packet).names
+            attrs = {
+                '__slots__': names,
+                'names': ('command_id',) + names,
+                'fields': frozenset(('command_id',) + names),
+                'command_id': cls.command_id,
+                'is_response': cls.is_response,
+                'fill_slots': slot_filler(names),
+                '__module__': __name__,
+                '__qualname__': 'Compact' + cls.__name__,
+            }
+            if hasattr(cls, 'body'):
+                attrs['body'] = cls.body
+            compact = compact_commands[cls.command_id] = type(
+                attrs['__qualname__'], (CompactCommand,), attrs)
+            # pickle looks classes up by module and name
+            globals()[compact.__name__] = compact
+        return compact
+
+    @classmethod
+    def template(cls, varying=(), **fixed):
+        return Template(cls, fixed, varying)
+
+    def encode(self, registry=None):
+        return bytes(self.encode_into(bytearray(), registry))
+
+    def encode_into(self, buf, registry=None):
+        """Appends encoded command to `buf` bytearray"""
+        self.load()
+        template = self._template
+        if template and template.matches(self):
+            return template.encode_into(buf, self, registry)
+
+        start = len(buf)
+        buf += EMPTY_HEADER
         cmd = self.__class__
-        if hasattr(cmd, 'body'):
-            body = cmd.body.encode(self)
+        try:
+            if hasattr(cmd, 'body'):
+                cmd.body.encode_into(buf, self)
+            (registry or tlv.default).encode_into(buf, self.optional_params())
+        except Exception:
+            del buf[start:]
+            raise
+
+        self['command_length'] = length = len(buf) - start
+        header_struct.pack_into(buf, start, length, self.command_id,
+                                int(self.get('command_status') or 0),
+                                int(self.get('sequence_number') or 0))
+        return buf
+
+
+class Template(object):
+    """Command with all body fields except `varying` encoded once
+
+    Commands whose fixed fields were changed are encoded field by field.
+    """
+    def __init__(self, cmd_type, fixed, varying=()):
+        self.cmd_type = cmd_type
+        self.fixed = fixed
+        self.fixed_items = list(fixed.items())
+        self.segments = []
+
+        chunk = bytearray()
+        body = getattr(cmd_type, 'body', None)
+        for step in body.steps if body else ():
+            if not set(step_names(step)).intersection(varying):
+                step.encode_into(chunk, fixed)
+            else:
+                chunk and self.segments.append(bytes(chunk))
+                chunk = bytearray()
+                self.segments.append(step.encode_into)
+        chunk and self.segments.append(bytes(chunk))
+
+        self.tlvs = tlv.encode(fixed)
+        # fixed TLVs are pre-encoded into self.tlvs
+        names = tlv.default.tag_names.union(['unknown_tlvs'])
+        self.tlv_exclude = names.intersection(fixed)
+
+    def make(self, **fields):
+        """Returns a command encoded with the template"""
+        cmd = self.cmd_type(**self.fixed)
+        cmd.update(fields)
+        object.__setattr__(cmd, '_template', self)
+        return cmd
+
+    def matches(self, ctx):
+        """Tells whether `ctx` still holds the fixed field values"""
+        get = ctx.get
+        return all(get(k) == v for k, v in self.fixed_items)
+
+    def encode(self, **fields):
+        ctx = dict(self.fixed)
+        ctx.update(fields)
+        if not self.matches(ctx):
+            return self.cmd_type(**ctx).encode()
+        return bytes(self.encode_into(bytearray(), ctx))
+
+    def encode_into(self, buf, ctx, registry=None):
+        start = len(buf)
+        buf += EMPTY_HEADER
+        try:
+            for segment in self.segments:
+                if isinstance(segment, bytes):
+                    buf += segment
+                else:
+                    segment(buf, ctx)
+            buf += self.tlvs
+            (registry or tlv.default).encode_into(buf, ctx, self.tlv_exclude)
+        except Exception:
+            del buf[start:]
+            raise
+
+        ctx['command_length'] = length = len(buf) - start
+        header_struct.pack_into(buf, start, length, self.cmd_type.command_id,
+                                int(ctx.get('command_status') or 0),
+                                int(ctx.get('sequence_number') or 0))
+        return buf
+
+
+class CompactCommand(object):
+    """Slotted command, TLVs and other extra keys are kept in a side dict"""
+    __slots__ = ('_extra', '_pending')
+    names = fields = ()
+    is_response = False
+    _template = None
 
-        body += tlv.encode(self)
+    def __new__(cls, **kwargs):
+        self = object.__new__(cls)
+        self._extra = None
+        self._pending = None
+        return self
 
-        self['command_length'] = 16 + len(body)
-        header = Header.encode(self)
-        return header + body
+    def __init__(self, **kwargs):
+        self.update(kwargs)
+
+    def __repr__(self):  # pragma: no cover
+        return '{}({})'.format(self.__class__.__name__, dict(self))
+
+    def fill(self, data):
+        """Sets slots from decoded field values"""
+        if len(data) == len(self.names):
+            return self.fill_slots(data)
+        del data['command_id']
+        for k, v in data.items():
+            setattr(self, k, v)
+
+    def __getattr__(self, name):
+        if name[0] != '_':
+            if self._pending:
+                self.load()
+                return getattr(self, name)
+            if self._extra and name in self._extra and name not in self.fields:
+                return self._extra[name]
+        raise AttributeError(name)
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+
+        self.load()
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.fields:
+            if key != 'command_id':
+                setattr(self, key, value)
+        elif self._extra is None:
+            self._extra = {key: value}
+        else:
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self.fields:
+            delattr(self, key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        self.load()
+        for name in self.names:
+            if name in self:
+                yield name
+        for name in self._extra or ():
+            yield name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        return isinstance(other, (dict, CompactCommand)) and dict(self) == dict(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(k, self[k]) for k in self]
+
+    def values(self):
+        return [self[k] for k in self]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def update(self, data=(), **kwargs):
+        for k, v in (data.items() if hasattr(data, 'items') else data):
+            self[k] = v
+        for k, v in kwargs.items():
+            self[k] = v
+
+    def optional_params(self):
+        return self._extra or {}
+
+    def __reduce__(self):
+        return compact_from_id, (self.command_id,), None, None, iter(self.items())
+
+    load = Command.__dict__['load']
+    encode = Command.__dict__['encode']
+    encode_into = Command.__dict__['encode_into']
 
 
 class CommandResp(Command):
@@ -62,6 +442,10 @@ class Header(Packet):
     sequence_number = Field(int32)
 
 
+header_struct = Header.steps[0].struct
+EMPTY_HEADER = b'\x00' * header_struct.size
+
+
 class Bind(Packet):
     system_id = Field(NString(max=16))
     password = Field(NString(max=9))
@@ -100,7 +484,7 @@ class SubmitResp(Packet):
     message_id = Field(NString(max=65))
 
 
-class GenericNack(Command):
+class GenericNack(CommandResp):
     command_id = 0x80000000
 
 
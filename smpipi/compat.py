@@ -1,5 +1,6 @@
 import sys
 import struct
+import binascii
 
 PY2 = sys.version_info[0] == 2
 
@@ -9,6 +10,7 @@ if PY2:  # pragma: no cover
     reduce = builtins.reduce
     string_types = (str, unicode)
     bchr = builtins.chr
+    unichr = builtins.unichr
 
     iterkeys = lambda d: d.iterkeys()
     itervalues = lambda d: d.itervalues()
@@ -17,6 +19,13 @@ if PY2:  # pragma: no cover
     listvalues = lambda d: d.values()
     listitems = lambda d: d.items()
 
+    def int_from_bytes(data):
+        return int(binascii.hexlify(data[::-1]) or '0', 16)
+
+    def int_to_bytes(value, size):
+        data = '%x' % value
+        return binascii.unhexlify(data.zfill(size * 2)[-size * 2:])[::-1]
+
     def bytestr(data, encoding='utf-8'):
         if isinstance(data, unicode):
             data = data.encode(encoding)
@@ -28,6 +37,7 @@ else:  # pragma: no cover
     from functools import reduce
     range = builtins.range
     string_types = (str, )
+    unichr = builtins.chr
 
     iterkeys = lambda d: d.keys()
     itervalues = lambda d: d.values()
@@ -36,6 +46,12 @@ else:  # pragma: no cover
     listvalues = lambda d: list(d.values())
     listitems = lambda d: list(d.items())
 
+    def int_from_bytes(data):
+        return int.from_bytes(data, 'little')
+
+    def int_to_bytes(value, size):
+        return (value & ((1 << size * 8) - 1)).to_bytes(size, 'little')
+
     def bytestr(data, encoding='utf-8'):
         if isinstance(data, str):
             data = data.encode(encoding)
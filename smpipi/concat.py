@@ -0,0 +1,84 @@
+import time
+from collections import OrderedDict
+
+from . import gsm
+
+TEXT_ENCODINGS = (gsm.SMPP_ENCODING_DEFAULT, gsm.SMPP_ENCODING_ISO88591,
+                  gsm.SMPP_ENCODING_ISO10646)
+
+
+def parse_udh(data):
+    """Returns tuple(ref, total, seq, payload), ref is None for non-concatenated data"""
+    if not data:
+        return None, 1, 1, data
+
+    udhl = bytearray(data[:1])[0]
+    header = bytearray(data[1:1 + udhl])
+    payload = data[1 + udhl:]
+    pos = 0
+    while pos + 1 < len(header):
+        iei, size = header[pos], header[pos + 1]
+        value = header[pos + 2:pos + 2 + size]
+        if iei == 0x00 and size == 3 and len(value) == 3:
+            return value[0], value[1], value[2], payload
+        if iei == 0x08 and size == 4 and len(value) == 4:
+            return value[0] << 8 | value[1], value[2], value[3], payload
+        pos += 2 + size
+
+    return None, 1, 1, payload
+
+
+def fragment(cmd):
+    """Returns tuple(ref, total, seq, payload) of a deliver_sm"""
+    data = cmd.get('message_payload') or cmd.short_message
+    if cmd.get('esm_class', 0) & gsm.SMPP_GSMFEAT_UDHI:
+        return parse_udh(data)
+    if 'sar_msg_ref_num' in cmd:
+        return (cmd.sar_msg_ref_num, cmd.get('sar_total_segments', 1),
+                cmd.get('sar_segment_seqnum', 1), data)
+    return None, 1, 1, data
+
+
+class Reassembler(object):
+    """Joins deliver_sm fragments, dropping stale or excess incomplete messages"""
+    def __init__(self, timeout=300, max_messages=1000):
+        self.timeout = timeout
+        self.max_messages = max_messages
+        self.pending = OrderedDict()
+
+    def expire(self, now=None):
+        now = now or time.time()
+        pending = self.pending
+        while pending and next(iter(pending.values()))[0] <= now:
+            pending.popitem(last=False)
+
+    def feed(self, cmd, now=None):
+        """Returns the completed command or None if fragments are missing"""
+        self.expire(now)
+        ref, total, seq, payload = fragment(cmd.load())
+        if ref is None or total <= 1 or not 1 <= seq <= total:
+            return self.complete(cmd, payload)
+
+        key = (cmd.get('source_addr'), ref, total)
+        entry = self.pending.get(key)
+        if entry is None:
+            while len(self.pending) >= self.max_messages:
+                self.pending.popitem(last=False)
+            entry = self.pending[key] = ((now or time.time()) + self.timeout, {})
+
+        parts = entry[1]
+        parts[seq] = payload
+        if len(parts) < total:
+            return None
+
+        del self.pending[key]
+        return self.complete(cmd, b''.join(parts[i] for i in range(1, total + 1)))
+
+    def complete(self, cmd, data):
+        cmd['message'] = data
+        coding = cmd.get('data_coding', 0)
+        try:
+            cmd['text'] = gsm.decode(data, coding) if coding in TEXT_ENCODINGS else None
+        except UnicodeDecodeError:
+            cmd['text'] = None
+        return cmd
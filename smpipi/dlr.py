@@ -0,0 +1,115 @@
+import re
+from collections import namedtuple
+
+from . import command
+from .packet import int32, DecodeError
+
+SMPP_MSGTYPE_MASK = 0x3C
+SMPP_MSGTYPE_DELIVERY_RECEIPT = 0x04
+
+# message_state TLV values to short message stat names
+states = {
+    1: b'ENROUTE',
+    2: b'DELIVRD',
+    3: b'EXPIRED',
+    4: b'DELETED',
+    5: b'UNDELIV',
+    6: b'ACCEPTD',
+    7: b'UNKNOWN',
+    8: b'REJECTD',
+}
+
+Receipt = namedtuple('Receipt', 'id stat err sub dlvrd submit_date done_date text state')
+
+receipt_re = re.compile(
+    br'id:(?P<id>\S*)'
+    br'(?:\s+sub:(?P<sub>\S*))?'
+    br'(?:\s+dlvrd:(?P<dlvrd>\S*))?'
+    br'(?:\s+submit date:(?P<submit_date>\S*))?'
+    br'(?:\s+done date:(?P<done_date>\S*))?'
+    br'(?:\s+stat:(?P<stat>\S*))?'
+    br'(?:\s+err:(?P<err>\S*))?'
+    br'(?:\s+text:(?P<text>.*))?', re.I | re.S)
+
+empty_match = dict.fromkeys(receipt_re.groupindex)
+
+
+def is_receipt(cmd):
+    """Checks esm_class message type, lazy commands are not decoded for it"""
+    if cmd.command_id != command.DeliverSM.command_id:
+        return False
+    pending = cmd._pending
+    esm_class = peek_esm_class(pending[0], pending[1]) if pending else cmd.esm_class
+    return esm_class & SMPP_MSGTYPE_MASK == SMPP_MSGTYPE_DELIVERY_RECEIPT
+
+
+def peek_esm_class(buf, offset=command.header_struct.size):
+    """Returns esm_class of a raw deliver_sm PDU without decoding it
+
+    `offset` is the body start. Raises DecodeError for malformed bodies.
+    """
+    body = command.Submit
+    try:
+        _, offset = body.service_type.type.decode(buf, offset)
+        _, offset = body.source_addr.type.decode(buf, offset + 2)
+        _, offset = body.destination_addr.type.decode(buf, offset + 2)
+        if offset >= len(buf):
+            raise DecodeError('deliver_sm body is too short')
+    except DecodeError as e:
+        e.command_status = command.ESME_RINVCMDLEN
+        raise
+    return bytearray(buf[offset:offset + 1])[0]
+
+
+def is_receipt_pdu(buf):
+    if len(buf) < command.header_struct.size:
+        raise DecodeError('PDU is shorter than header', command.ESME_RINVCMDLEN)
+    return (int32.struct.unpack_from(buf, 4)[0] == command.DeliverSM.command_id
+            and peek_esm_class(buf) & SMPP_MSGTYPE_MASK == SMPP_MSGTYPE_DELIVERY_RECEIPT)
+
+
+def parse(cmd):
+    """Returns Receipt for a delivery receipt deliver_sm or None"""
+    if not is_receipt(cmd):
+        return None
+
+    match = receipt_re.search(cmd.get('short_message') or cmd.get('message_payload') or b'')
+    fields = match.groupdict() if match else empty_match
+    state = cmd.get('message_state')
+    msg_id = cmd.get('receipted_message_id')
+    return Receipt(
+        id=msg_id.rstrip(b'\x00') if msg_id else fields['id'],
+        stat=fields['stat'] or states.get(state),
+        err=fields['err'],
+        sub=fields['sub'],
+        dlvrd=fields['dlvrd'],
+        submit_date=fields['submit_date'],
+        done_date=fields['done_date'],
+        text=fields['text'],
+        state=state,
+    )
+
+
+def parse_pdu(buf, registry=None):
+    """Returns Receipt for a raw deliver_sm PDU or None"""
+    if not is_receipt_pdu(buf):
+        return None
+    return parse(command.Command.decode(buf, registry=registry))
+
+
+def parse_many(items, registry=None, on_error=None):
+    """Yields receipts from an iterable of commands or raw PDUs
+
+    Malformed items are skipped, `on_error(item, exc)` is called for them.
+    """
+    for item in items:
+        try:
+            if isinstance(item, (command.Command, command.CompactCommand)):
+                receipt = parse(item)
+            else:
+                receipt = parse_pdu(item, registry)
+        except DecodeError as e:
+            on_error and on_error(item, e)
+            continue
+        if receipt:
+            yield receipt
@@ -2,7 +2,8 @@
 import binascii
 import random
 
-from .compat import bytestr, bchr
+from . import command
+from .compat import bytestr, bchr, unichr, int_from_bytes, int_to_bytes
 
 # from http://stackoverflow.com/questions/2452861/python-library-for-converting-plain-text-ascii-into-gsm-7-bit-character-set
 gsm = (u"@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>"
@@ -25,6 +26,18 @@ EIGHTBIT_MP_SIZE = EIGHTBIT_SIZE - 6
 UCS2_MP_SIZE = UCS2_SIZE - 3
 
 
+ESCAPE = u'\x1b'
+
+# unicode char -> latin-1 chars of its GSM septets
+encode_table = dict((ord(c), ESCAPE + unichr(i))
+                    for i, c in enumerate(ext) if c != u'`')
+encode_table.update((ord(c), unichr(i)) for i, c in enumerate(gsm))
+gsm_chars = frozenset(unichr(c) for c in encode_table)
+
+decode_table = dict((i, c) for i, c in enumerate(gsm))
+ext_decode_table = dict((unichr(i), c) for i, c in enumerate(ext) if c != u'`')
+
+
 class EncodeError(ValueError):
     pass
 
@@ -33,23 +46,41 @@ class MessageTooLong(ValueError):
     pass
 
 
+def to_text(text):
+    """Decodes byte strings (native str on py2) as utf-8"""
+    return text.decode('utf-8') if isinstance(text, bytes) else text
+
+
+def is_gsm(text):
+    return gsm_chars.issuperset(to_text(text))
+
+
 def gsm_encode(plaintext, hex=False):
     """Replace non-GSM ASCII symbols"""
-    res = b''
-    for c in plaintext:
-        idx = gsm.find(c)
-        if idx != -1:
-            res += bchr(idx)
-            continue
-        idx = ext.find(c)
-        if idx != -1:
-            res += bchr(27) + bchr(idx)
-            continue
+    plaintext = to_text(plaintext)
+    if not gsm_chars.issuperset(plaintext):
         raise EncodeError()
+    res = plaintext.translate(encode_table).encode('latin-1')
     return binascii.b2a_hex(res) if hex else res
 
 
+def gsm_decode(data):
+    text = data.decode('latin-1')
+    if ESCAPE not in text:
+        return text.translate(decode_table)
+
+    head, _, rest = text.partition(ESCAPE)
+    result = [head.translate(decode_table)]
+    for chunk in rest.split(ESCAPE):
+        if chunk:
+            c = chunk[0]
+            result.append(ext_decode_table.get(c) or c.translate(decode_table))
+            result.append(chunk[1:].translate(decode_table))
+    return u''.join(result)
+
+
 def encode(text):
+    text = to_text(text)
     try:
         text = gsm_encode(text)
         encoding = SMPP_ENCODING_DEFAULT
@@ -60,38 +91,187 @@ def encode(text):
     return text, encoding
 
 
-def make_parts(text):
-    """Returns tuple(parts, encoding, esm_class)"""
+_lane_masks = {}
+
+
+def lane_masks(lanes):
+    """(lo, hi, shift) per level merging pairs of septet lanes"""
     try:
-        text = gsm_encode(text)
-        encoding = SMPP_ENCODING_DEFAULT
-        need_split = len(text) > SEVENBIT_SIZE
-        partsize = SEVENBIT_MP_SIZE
-        encode = lambda s: s
-    except EncodeError:
-        encoding = SMPP_ENCODING_ISO10646
-        need_split = len(text) > UCS2_SIZE
-        partsize = UCS2_MP_SIZE
-        encode = lambda s: s.encode('utf-16-be')
-
-    esm_class = SMPP_MSGTYPE_DEFAULT
-
-    if need_split:
-        esm_class = SMPP_GSMFEAT_UDHI
-
-        starts = tuple(range(0, len(text), partsize))
-        if len(starts) > 255:
-            raise MessageTooLong()
-
-        parts = []
-        ipart = 1
-        uid = random.randint(0, 255)
-        for start in starts:
-            parts.append(b''.join((b'\x05\x00\x03', bchr(uid),
-                                  bchr(len(starts)), bchr(ipart),
-                                  encode(text[start:start + partsize]))))
-            ipart += 1
+        return _lane_masks[lanes]
+    except KeyError:
+        pass
+
+    masks = []
+    unit, content = 8, 7
+    while unit < lanes * 8:
+        period = unit * 2
+        rep = int_from_bytes((b'\x01' + b'\x00' * (period // 8 - 1)) * (lanes * 8 // period))
+        bits = (1 << content) - 1
+        masks.append((bits * rep, (bits << content) * rep, unit - content))
+        unit, content = period, content * 2
+
+    _lane_masks[lanes] = masks
+    return masks
+
+
+def septet_lanes(count):
+    lanes = 1
+    while lanes < count:
+        lanes *= 2
+    return lanes
+
+
+def udh_fill_bits(udh_size):
+    """Fill bits aligning septets after `udh_size` octets of UDH"""
+    return (7 - udh_size * 8 % 7) % 7
+
+
+def pack7(septets, fill=0):
+    """Packs one-septet-per-octet GSM data into 7-bit packed form"""
+    count = len(septets)
+    if not count:
+        return b''
+
+    lanes = septet_lanes(count)
+    x = int_from_bytes(septets) & (0x7f * int_from_bytes(b'\x01' * count))
+    for lo, hi, shift in lane_masks(lanes):
+        x = (x & lo) | ((x >> shift) & hi)
+
+    return int_to_bytes(x << fill, (count * 7 + fill + 7) // 8)
+
+
+def unpack7(data, count=None, fill=0):
+    """Unpacks 7-bit packed GSM data into one septet per octet"""
+    if count is None:
+        count = (len(data) * 8 - fill) // 7
+    if count <= 0:
+        return b''
+
+    lanes = septet_lanes(count)
+    x = (int_from_bytes(data) >> fill) & ((1 << count * 7) - 1)
+    for lo, hi, shift in reversed(lane_masks(lanes)):
+        x = (x & lo) | ((x & hi) << shift)
+
+    return int_to_bytes(x, lanes)[:count]
+
+
+def decode(data, encoding):
+    if encoding == SMPP_ENCODING_ISO10646:
+        return data.decode('utf-16-be')
+    elif encoding == SMPP_ENCODING_ISO88591:
+        return data.decode('latin-1')
+    return gsm_decode(data)
+
+
+def segment_size(encoding, udh_size):
+    """Payload octets (septets for GSM) of a segment with `udh_size` octets of UDH"""
+    if encoding == SMPP_ENCODING_DEFAULT:
+        return (EIGHTBIT_SIZE - udh_size) * 8 // 7
+    return (EIGHTBIT_SIZE - udh_size) // 2 * 2
+
+
+def split(data, encoding, size):
+    """Returns (start, end) bounds keeping GSM escapes and surrogate pairs whole"""
+    bounds = []
+    start = 0
+    total = len(data)
+    while start < total:
+        end = start + size
+        if end >= total:
+            end = total
+        elif encoding == SMPP_ENCODING_DEFAULT:
+            if data[end - 1:end] == b'\x1b':
+                end -= 1
+        elif b'\xd8' <= data[end - 2:end - 1] <= b'\xdb':
+            end -= 2
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+def udh_size(ref16):
+    return 7 if ref16 else 6
+
+
+def segments(data, encoding, udh):
+    """Returns segment bounds or None if `data` fits into a single message"""
+    if len(data) <= segment_size(encoding, 0):
+        return None
+
+    bounds = split(data, encoding, segment_size(encoding, udh))
+    if len(bounds) > 255:
+        raise MessageTooLong()
+    return bounds
+
+
+def count_parts(text, ref16=False):
+    """Returns tuple(number of parts, encoding) without building parts"""
+    data, encoding = encode(text)
+    bounds = segments(data, encoding, udh_size(ref16))
+    return len(bounds) if bounds else 1, encoding
+
+
+def make_udh(ref, total, seq, ref16=False):
+    if ref16:
+        return b'\x06\x08\x04' + bchr(ref >> 8) + bchr(ref & 0xff) + bchr(total) + bchr(seq)
+    return b'\x05\x00\x03' + bchr(ref) + bchr(total) + bchr(seq)
+
+
+def make_parts(text, packed=False, ref16=False):
+    """Returns tuple(parts, encoding, esm_class)"""
+    data, encoding = encode(text)
+    udh = udh_size(ref16)
+    bounds = segments(data, encoding, udh)
+    packed = packed and encoding == SMPP_ENCODING_DEFAULT
+
+    if not bounds:
+        return (pack7(data) if packed else data,), encoding, SMPP_MSGTYPE_DEFAULT
+
+    fill = udh_fill_bits(udh)
+    ref = random.randint(0, 0xffff if ref16 else 0xff)
+    parts = []
+    for seq, (start, end) in enumerate(bounds, 1):
+        chunk = data[start:end]
+        if packed:
+            chunk = pack7(chunk, fill)
+        parts.append(make_udh(ref, len(bounds), seq, ref16) + chunk)
+
+    return parts, encoding, SMPP_GSMFEAT_UDHI
+
+
+def make_submits(text, mode='udh', packed=False, ref16=False, **fields):
+    """Returns list of SubmitSM commands for `text`
+
+    `mode` selects concatenation: 'udh' header in short_message, 'sar'
+    TLVs or a single 'payload' command with message_payload TLV.
+    """
+    if mode not in ('udh', 'sar', 'payload'):
+        raise ValueError('unknown concatenation mode {!r}'.format(mode))
+
+    if mode == 'udh':
+        parts, encoding, esm_class = make_parts(text, packed, ref16)
+        parts = [(p, {}) for p in parts]
     else:
-        parts = (encode(text),)
+        data, encoding = encode(text)
+        esm_class = SMPP_MSGTYPE_DEFAULT
+        bounds = mode == 'sar' and segments(data, encoding, 0)
+        if mode == 'payload':
+            parts = [(b'', {'message_payload': data})]
+        elif bounds:
+            ref = random.randint(0, 0xffff)
+            parts = [(data[start:end], {'sar_msg_ref_num': ref,
+                                        'sar_total_segments': len(bounds),
+                                        'sar_segment_seqnum': seq})
+                     for seq, (start, end) in enumerate(bounds, 1)]
+        else:
+            parts = [(data, {})]
+
+        if packed and encoding == SMPP_ENCODING_DEFAULT:
+            parts = [(pack7(p), opts) for p, opts in parts]
+
+    fields['data_coding'] = encoding
+    fields['esm_class'] = fields.get('esm_class', 0) | esm_class
 
-    return parts, encoding, esm_class
+    template = command.SubmitSM.template(('short_message',), **fields)
+    return [template.make(short_message=short_message, **opts)
+            for short_message, opts in parts]
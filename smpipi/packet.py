@@ -2,6 +2,13 @@ from struct import Struct
 from .compat import bytestr, range
 
 
+class DecodeError(ValueError):
+    """Malformed PDU data, `command_status` is the SMPP error to answer with"""
+    def __init__(self, message, command_status=None):
+        ValueError.__init__(self, message)
+        self.command_status = command_status
+
+
 class AttrDict(dict):
     __getattr__ = dict.__getitem__
     __setattr__ = dict.__setitem__
@@ -11,12 +18,20 @@ class Integer(object):
     default = 0
 
     def __init__(self, fmt):
+        self.fmt = fmt
         self.struct = Struct(fmt)
+        self.zero = b'\x00' * self.struct.size
 
     def encode(self, value):
-        if value is None:
-            value = 0
-        return self.struct.pack(int(value))
+        buf = bytearray()
+        self.encode_into(buf, value)
+        return bytes(buf)
+
+    def encode_into(self, buf, value):
+        pos = len(buf)
+        buf += self.zero
+        if value:
+            self.struct.pack_into(buf, pos, int(value))
 
     def decode(self, buf, offset):
         value, = self.struct.unpack_from(buf, offset)
@@ -28,11 +43,16 @@ class String(object):
         self.max = max
 
     def encode(self, value):
-        if value is None:
-            value = ''
+        buf = bytearray()
+        size = self.encode_into(buf, value)
+        return bytes(buf), size
 
+    def encode_into(self, buf, value):
+        if value is None:
+            return 0
         value = bytestr(value)
-        return value, len(value)
+        buf += value
+        return len(value)
 
     def decode(self, buf, offset, size):
         return buf[offset:offset+size], offset+size
@@ -43,13 +63,19 @@ class NString(object):
         self.max = max
 
     def encode(self, value):
-        if value is None:
-            value = ''
-        return bytestr(value) + b'\x00'
+        buf = bytearray()
+        self.encode_into(buf, value)
+        return bytes(buf)
+
+    def encode_into(self, buf, value):
+        if value is not None:
+            buf += bytestr(value)
+        buf.append(0)
 
     def decode(self, buf, offset):
         pos = buf.find(b'\x00', offset, offset+self.max)
-        assert pos >= 0
+        if pos < 0:
+            raise DecodeError('unterminated or too long string at {}'.format(offset))
         return buf[offset:pos], pos + 1
 
 
@@ -58,10 +84,14 @@ class Array(object):
         self.packet = packet
 
     def encode(self, value):
-        result = b''
+        buf = bytearray()
+        size = self.encode_into(buf, value)
+        return bytes(buf), size
+
+    def encode_into(self, buf, value):
         for v in value or []:
-            result += self.packet.encode(v)
-        return result, value and len(value) or 0
+            self.packet.encode_into(buf, v)
+        return value and len(value) or 0
 
     def decode(self, buf, offset, size):
         result = []
@@ -94,7 +124,12 @@ class Field(object):
         return offset
 
     def encode(self, ctx):
-        return self.type.encode(ctx.get(self.name))
+        buf = bytearray()
+        self.encode_into(buf, ctx)
+        return bytes(buf)
+
+    def encode_into(self, buf, ctx):
+        self.type.encode_into(buf, ctx.get(self.name))
 
 
 class SizeField(Field):
@@ -110,10 +145,13 @@ class SizeField(Field):
         ctx[self.name] = value
         return offset
 
-    def encode(self, ctx):
-        value, size = self.type.encode(ctx.get(self.name))
+    def encode_into(self, buf, ctx):
+        pos = len(buf)
+        length_type = self.length_field.type
+        buf += length_type.zero
+        size = self.type.encode_into(buf, ctx.get(self.name))
         ctx[self.length_field.name] = size
-        return self.length_field.encode(ctx) + value
+        length_type.struct.pack_into(buf, pos, size)
 
 
 class DispatchField(Field):
@@ -129,9 +167,61 @@ class DispatchField(Field):
         ctx.update(value)
         return offset
 
-    def encode(self, ctx):
+    def encode_into(self, buf, ctx):
         dval = ctx[self.name]
-        return self.type.encode(dval) + self.mapping[dval].encode(ctx)
+        self.type.encode_into(buf, dval)
+        self.mapping[dval].encode_into(buf, ctx)
+
+
+class IntegerRun(object):
+    """Adjacent integer fields packed with a single struct"""
+    def __init__(self, fields):
+        self.names = tuple(f.name for f in fields)
+        self.struct = Struct('!' + ''.join(f.type.fmt.lstrip('!') for f in fields))
+        self.size = self.struct.size
+        self.zero = b'\x00' * self.size
+
+    def decode(self, ctx, buf, offset):
+        ctx.update(zip(self.names, self.struct.unpack_from(buf, offset)))
+        return offset + self.size
+
+    def encode_into(self, buf, ctx):
+        get = ctx.get
+        pos = len(buf)
+        buf += self.zero
+        self.struct.pack_into(buf, pos, *[int(get(name) or 0) for name in self.names])
+
+
+def is_integer_field(field):
+    return type(field) is Field and isinstance(field.type, Integer)
+
+
+def compile_fields(fields):
+    steps = []
+    run = []
+    for field in fields + [None]:
+        if field is not None and is_integer_field(field):
+            run.append(field)
+            continue
+
+        if len(run) > 1:
+            steps.append(IntegerRun(run))
+        else:
+            steps.extend(run)
+        run = []
+
+        if field is not None:
+            steps.append(field)
+
+    return steps
+
+
+def step_names(step):
+    if isinstance(step, IntegerRun):
+        return step.names
+    elif isinstance(step, SizeField):
+        return (step.name, step.length_field.name)
+    return (step.name,)
 
 
 def with_name(field, name):
@@ -143,21 +233,30 @@ class PacketMeta(type):
     def __init__(self, name, bases, fields):
         fmt_fields = [with_name(v, k) for k, v in fields.items() if isinstance(v, Field)]
         self.fields = sorted(fmt_fields, key=lambda r: r.order)
+        self.steps = compile_fields(self.fields)
+        self.names = tuple(n for s in self.steps for n in step_names(s))
+        self._decoders = [s.decode for s in self.steps]
+        self._encoders = [s.encode_into for s in self.steps]
 
 
 class Packet(PacketMeta('PacketBase', (object,), {})):
     @classmethod
     def decode(cls, buf, offset=0):
         result = AttrDict()
-        for field in cls.fields:
-            offset = field.decode(result, buf, offset)
+        return result, cls.decode_into(result, buf, offset)
 
-        return result, offset
+    @classmethod
+    def decode_into(cls, ctx, buf, offset=0):
+        for decode in cls._decoders:
+            offset = decode(ctx, buf, offset)
+        return offset
 
     @classmethod
     def encode(cls, data):
-        result = b''
-        for field in cls.fields:
-            result += field.encode(data)
+        return bytes(cls.encode_into(bytearray(), data))
 
-        return result
+    @classmethod
+    def encode_into(cls, buf, data):
+        for encode in cls._encoders:
+            encode(buf, data)
+        return buf
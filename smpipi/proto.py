@@ -1,12 +1,15 @@
 import time
 import logging
+import warnings
 
 from binascii import hexlify
 from collections import deque
-from weakref import WeakValueDictionary
+from contextlib import contextmanager
+from heapq import heappush, heappop, heapify
 
-from . import command
-from .packet import int32
+from . import command, tlv
+from .concat import Reassembler
+from .packet import DecodeError
 
 pdu_log = logging.getLogger('smpipi.pdu')
 
@@ -15,44 +18,174 @@ class BrokenLink(Exception):
     pass
 
 
+class CommandError(Exception):
+    """Rejects a request with `command_status`"""
+    def __init__(self, command_status, message=None):
+        Exception.__init__(self, message or hex(command_status))
+        self.command_status = command_status
+
+
+class PDUError(object):
+    """Malformed frame received from peer, answered with GenericNack
+
+    A `fatal` error means the stream can not be resynchronized.
+    """
+    def __init__(self, command_status, sequence_number=0, command_id=None,
+                 reason=None, fatal=False):
+        self.command_status = command_status
+        self.sequence_number = sequence_number
+        self.command_id = command_id
+        self.reason = reason
+        self.fatal = fatal
+
+    def __repr__(self):  # pragma: no cover
+        return 'PDUError({:#x}, {!r})'.format(self.command_status, self.reason)
+
+
 class Proto(object):
-    def __init__(self, logger=None):
-        self.buffer = b''
+    compact_size = 65536
+    max_pdu_size = 131072
+
+    def __init__(self, logger=None, lazy=False, compact=False, tlv_registry=None,
+                 max_pdu_size=None):
+        self.buffer = bytearray()
+        self.offset = 0
+        self.broken = False
+        self.max_pdu_size = max_pdu_size or self.max_pdu_size
+        self.lazy = lazy
+        self.compact_commands = compact
+        self.tlv_registry = tlv.get_registry(tlv_registry)
         self.log = logger or pdu_log
 
     def receive_bytes(self, data):
-        self.buffer += data
-
-        while len(self.buffer) >= 4:
-            size, _ = int32.decode(self.buffer, 0)
-            if len(self.buffer) < size:
+        if self.broken:
+            return
+
+        buf = self.buffer
+        buf += data
+        unpack_header = command.header_struct.unpack_from
+        header_size = command.header_struct.size
+        max_size = self.max_pdu_size
+        debug = self.log.isEnabledFor(logging.DEBUG)
+
+        while len(buf) - self.offset >= header_size:
+            start = self.offset
+            size, command_id, _, seq = unpack_header(buf, start)
+            if not header_size <= size <= max_size:
+                self.broken = True
+                self.log.warning('>> %s invalid command_length %d',
+                                 hexlify(buf[start:start + header_size]), size)
+                del buf[:]
+                self.offset = 0
+                yield PDUError(command.ESME_RINVCMDLEN, seq, command_id,
+                               'invalid command_length {}'.format(size), fatal=True)
+                return
+
+            if len(buf) - start < size:
                 break
-            pdu = self.buffer[:size]
-            self.buffer = self.buffer[size:]
-            pdu_hex = hexlify(pdu)
+            pdu = bytes(buf[start:start + size])
+            self.offset = start + size
             try:
-                cmd = command.Command.decode(pdu)
-            except:  # pragma: no cover
-                self.log.debug('>> %s DecodeError', pdu_hex)
-                raise
+                cmd = command.Command.decode(pdu, self.lazy, self.compact_commands,
+                                             self.tlv_registry)
+            except DecodeError as e:
+                self.log.warning('>> %s %s', hexlify(pdu), e)
+                yield PDUError(e.command_status, seq, command_id, str(e))
             else:
-                self.log.debug('>> %s %r', pdu_hex, cmd)
+                debug and self.log.debug('>> %s %r', hexlify(pdu), cmd)
                 yield cmd
 
+        self.compact()
+
+    def compact(self):
+        if self.offset and (self.offset >= len(self.buffer)
+                            or self.offset >= self.compact_size):
+            del self.buffer[:self.offset]
+            self.offset = 0
+
     def send_bytes(self, *events):
-        result = []
-        for pdu in events:
-            payload = pdu.encode()
-            result.append(payload)
-            self.log.debug('<< %s %r', hexlify(payload), pdu)
+        return self.encode_into(bytearray(), *events)
 
-        return b''.join(result)
+    def encode_into(self, buf, *events):
+        debug = self.log.isEnabledFor(logging.DEBUG)
+        for pdu in events:
+            start = len(buf)
+            pdu.encode_into(buf, self.tlv_registry)
+            debug and self.log.debug('<< %s %r', hexlify(buf[start:]), pdu)
+
+        return buf
+
+
+class ReceiveBuffer(object):
+    """Receive buffer of fixed size or adapting between size and max_size"""
+    def __init__(self, size=None, max_size=None):
+        self.min_size = self.size = size or 4096
+        self.max_size = max(max_size or self.size, self.size)
+        self.view = None
+
+    def get_buffer(self):
+        if self.view is None:
+            self.view = memoryview(bytearray(self.size))
+        return self.view
+
+    def received(self, nbytes):
+        data = self.view[:nbytes]
+        if self.update(nbytes):
+            self.view = None
+        return data
+
+    def update(self, nbytes):
+        if nbytes >= self.size and self.size < self.max_size:
+            self.size = min(self.size * 2, self.max_size)
+        elif nbytes <= self.size // 4 and self.size > self.min_size:
+            self.size = max(self.size // 2, self.min_size)
+        else:
+            return False
+        return True
+
+
+class Throttle(object):
+    """Token bucket which slows down on SMSC throttling errors"""
+    def __init__(self, rate, burst=None, min_rate=None, recovery=None):
+        self.rate = self.max_rate = float(rate)
+        self.burst = burst or max(1, self.rate)
+        self.min_rate = min_rate or self.max_rate / 20
+        self.recovery = recovery or self.max_rate / 50
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def refill(self, now=None):
+        now = now or time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now=None):
+        """Consumes a token, returns 0 or a delay until one is available"""
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def backoff(self, now=None):
+        self.refill(now)
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+
+    def recover(self):
+        self.rate = min(self.max_rate, self.rate + self.recovery)
 
 
 class Response(object):
-    def __init__(self, request, callback):
+    expire = None
+    timed_out = False
+    notify = True
+    response_timeout = None
+
+    def __init__(self, request, callback, on_timeout=None):
         self.request = request
         self.callback = callback
+        self.on_timeout = on_timeout
         self.ready = False
 
     def resolve(self, response):
@@ -61,38 +194,196 @@ class Response(object):
         if self.callback:
             self.callback(self)
 
+    def timeout(self):
+        self.timed_out = True
+        if self.on_timeout:
+            self.on_timeout(self)
+
+
+throttled_commands = (command.SubmitSM, command.SubmitMulti, command.DataSM)
+
+
+class Pipeline(object):
+    def __init__(self, conn, messages, window, callback=None):
+        self.conn = conn
+        self.messages = iter(messages)
+        self.window = window
+        self.callback = callback
+        self.in_flight = 0
+        self.exhausted = False
+        self.results = deque()
+
+    @property
+    def done(self):
+        return self.exhausted and not self.in_flight
+
+    def fill(self):
+        if self.conn.defer_fill(self):
+            return self
+
+        cmds = []
+        while not self.exhausted and self.in_flight + len(cmds) < self.window:
+            try:
+                msg = next(self.messages)
+            except StopIteration:
+                self.exhausted = True
+            else:
+                if not isinstance(msg, command.Command):
+                    msg = command.SubmitSM(**msg)
+                cmds.append(msg)
+
+        self.in_flight += len(cmds)
+        self.conn.send_many(cmds, self._resolved, self._resolved)
+        return self
+
+    def _resolved(self, resp):
+        self.in_flight -= 1
+        response = resp.response if resp.ready else None
+        self.results.append((resp.request, response))
+        if self.callback:
+            self.callback(resp.request, response)
+        self.fill()
+
 
 class BaseConnection(object):
-    def __init__(self, response_queue_size=None, enquire_timeout=None, logger=None):
-        self.proto = Proto(logger)
+    def __init__(self, response_timeout=None, enquire_timeout=None, logger=None,
+                 lazy=False, flush_pdus=None, flush_bytes=None,
+                 recv_size=None, recv_max_size=None, tps=None, burst=None,
+                 reassemble=False, compact=False, tlv_registry=None, max_pdu_size=None,
+                 response_queue_size=None):
+        if response_queue_size is not None:
+            warnings.warn('response_queue_size is ignored, in-flight requests expire '
+                          'after response_timeout', DeprecationWarning, stacklevel=2)
+        self.proto = Proto(logger, lazy, compact, tlv_registry, max_pdu_size)
+        self.receiver = ReceiveBuffer(recv_size, recv_max_size)
+        self.throttle = tps and Throttle(tps, burst)
+        self.throttled = deque()
+        self.reassembler = reassemble and Reassembler()
         self.sequence_number = 0
 
+        self.flush_pdus = flush_pdus or 64
+        self.flush_bytes = flush_bytes or 65536
+        self.buffering = False
+        self.output = bytearray()
+        self.output_pdus = 0
+
         self.last_enquire = time.time()
         self.enquire_timeout = enquire_timeout or 300
         self.enquire_response = None
 
-        self.response_queue = deque([], response_queue_size or 1000)
-        self.response_map = WeakValueDictionary()
+        self.response_timeout = response_timeout or 60
+        self.in_flight = {}
+        self.deadlines = []
 
     def next_sequence(self):
         self.sequence_number += 1
         return self.sequence_number
 
+    def write(self, *cmds):
+        if not self.buffering:
+            return self.on_send(self.proto.send_bytes(*cmds))
+
+        self.proto.encode_into(self.output, *cmds)
+        self.output_pdus += len(cmds)
+        if self.output_pdus >= self.flush_pdus or len(self.output) >= self.flush_bytes:
+            return self.flush()
+
+    def flush(self):
+        if self.output:
+            data = self.output
+            self.output = bytearray()
+            self.output_pdus = 0
+            return self.on_send(data)
+
+    @contextmanager
+    def batch(self):
+        """Coalesces PDUs written inside the block into as few sends as possible"""
+        if self.buffering:
+            yield
+            return
+
+        self.buffering = True
+        try:
+            yield
+        finally:
+            self.buffering = False
+            self.flush()
+
     def reply(self, cmd):
-        return self.on_send(self.proto.send_bytes(cmd))
+        return self.write(cmd)
 
-    def send(self, cmd, callback=None, notify=True):
+    def _register(self, cmd, callback, on_timeout=None):
         cmd.sequence_number = self.next_sequence()
-        resp = Response(cmd, callback)
-        if notify:
-            self.response_map[cmd.sequence_number] = resp
-            self.response_queue.append(resp)
-        self.reply(cmd)
+        return Response(cmd, callback, on_timeout)
+
+    def _track(self, resp, timeout=None):
+        """Starts waiting for the response of a written request"""
+        seq = resp.request.sequence_number
+        resp.expire = time.time() + (timeout or self.response_timeout)
+        self.in_flight[seq] = resp
+        if len(self.deadlines) > 2 * len(self.in_flight) + 64:
+            self.deadlines = [(r.expire, s, r) for s, r in self.in_flight.items()]
+            heapify(self.deadlines)
+        else:
+            heappush(self.deadlines, (resp.expire, seq, resp))
+
+    def _write_request(self, resp):
+        self.write(resp.request)
+        resp.notify and self._track(resp, resp.response_timeout)
+
+    def send(self, cmd, callback=None, notify=True, timeout=None, on_timeout=None):
+        resp = self._register(cmd, callback, on_timeout)
+        resp.notify = notify
+        resp.response_timeout = timeout
+        if self.throttle and type(cmd) in throttled_commands:
+            self.throttled.append(resp)
+            self.release()
+        else:
+            self._write_request(resp)
         return resp
 
+    def send_many(self, cmds, callback=None, on_timeout=None):
+        result = [self._register(cmd, callback, on_timeout) for cmd in cmds]
+        with self.batch():
+            for resp in result:
+                if self.throttle and type(resp.request) in throttled_commands:
+                    self.throttled.append(resp)
+                else:
+                    self._write_request(resp)
+            self.throttled and self.release()
+        return result
+
+    def release(self):
+        """Writes throttled commands allowed by the rate limit
+
+        Response deadlines of throttled commands start once they are written.
+        """
+        while self.throttled:
+            delay = 0
+            with self.batch():
+                while self.throttled:
+                    delay = self.throttle.take()
+                    if delay:
+                        break
+                    self._write_request(self.throttled.popleft())
+            if delay and not self.on_throttle(delay):
+                break
+
+    def on_throttle(self, delay):
+        """Schedules release() in `delay` seconds, returns True if already waited"""
+        return False
+
+    def defer_fill(self, pipeline):
+        """Returns True if pipeline refill must wait for the transport to drain"""
+        return False
+
     def on_send(self, data):  # pragma: no cover
         pass
 
+    def _close(self, _=None):
+        self.flush()
+        self.on_close()
+
     def on_close(self):  # pragma: no cover
         pass
 
@@ -112,40 +403,92 @@ class BaseConnection(object):
         if not reply.called:
             self.reply(resp)
 
+    def _delivered(self, req, reply, future):
+        """Finishes asynchronous on_deliver, nacks lazy bodies failed to decode"""
+        error = not future.cancelled() and future.exception()
+        if isinstance(error, DecodeError) and not reply.called:
+            return self._decode_failed(req, error)
+        if error:
+            self.proto.log.error('on_deliver failed for %r: %r', req, error)
+        reply.called or reply()
+
+    def _decode_failed(self, cmd, error):
+        self.on_pdu_error(PDUError(error.command_status, cmd.sequence_number,
+                                   cmd.command_id, str(error)))
+
+    def on_pdu_error(self, error):
+        """Answers malformed frame with GenericNack, closes on fatal errors"""
+        self.reply(command.GenericNack(command_status=error.command_status,
+                                       sequence_number=error.sequence_number))
+        if error.fatal:
+            self._close()
+
     def handle(self, cmd):
+        if type(cmd) is PDUError:
+            return self.on_pdu_error(cmd)
+
         self.last_enquire = time.time()
-        cmd_type = type(cmd)
+        cmd_type = command.command_from_data(cmd)
         seq = {'sequence_number': cmd.sequence_number}
         if cmd_type is command.EnquireLink:
             self.reply(command.EnquireLinkResp(**seq))
         elif cmd_type is command.Unbind:
             self.reply(command.UnbindResp(**seq))
-            self.on_close()
+            self._close()
         elif cmd_type.is_response:
-            resp = self.response_map.pop(cmd.sequence_number, None)
+            resp = self.in_flight.pop(cmd.sequence_number, None)
             if resp:
+                if self.throttle and type(resp.request) in throttled_commands:
+                    if cmd.command_status == command.ESME_RTHROTTLED:
+                        self.throttle.backoff()
+                    else:
+                        self.throttle.recover()
                 resp.resolve(cmd)
         else:
             resp = cmd_type.response(**seq)
+            if self.reassembler and cmd_type is command.DeliverSM:
+                cmd = self.reassembler.feed(cmd)
+                if cmd is None:
+                    self.reply(resp)
+                    return
             self._deliver(cmd, resp)
 
     def feed(self, data):
-        for e in self.proto.receive_bytes(data):
-            self.handle(e)
+        with self.batch():
+            for e in self.proto.receive_bytes(data):
+                try:
+                    self.handle(e)
+                except DecodeError as err:
+                    # lazy commands decode their body on first field access
+                    self._decode_failed(e, err)
+            self.expire_requests()
+            self.throttled and self.release()
+
+    def expire_requests(self, now=None):
+        """Drops in-flight requests past their deadline and fires their timeouts"""
+        now = now or time.time()
+        deadlines = self.deadlines
+        while deadlines and deadlines[0][0] <= now:
+            _, seq, resp = heappop(deadlines)
+            if not resp.ready and self.in_flight.get(seq) is resp:
+                del self.in_flight[seq]
+                resp.timeout()
 
     def ping(self, response_timeout=10):
         now = time.time()
+        self.expire_requests(now)
+        self.throttled and self.release()
         if self.enquire_response:
             if self.enquire_response.ready:
                 self.enquire_response = None
             elif self.enquire_response.expire < now:
                 raise BrokenLink('SMPP link broken: no response from SMSC')
         elif self.last_enquire + self.enquire_timeout < now:
-            self.enquire_response = self.send(command.EnquireLink())
-            self.enquire_response.expire = now + response_timeout
+            self.enquire_response = self.send(command.EnquireLink(),
+                                              timeout=response_timeout)
 
     def unbind(self):
-        return self.send(command.Unbind(), lambda _: self.on_close())
+        return self.send(command.Unbind(), self._close)
 
 
 class BaseESME(BaseConnection):
@@ -169,3 +512,42 @@ class BaseESME(BaseConnection):
     def send_message(self, **kwargs):
         cb = kwargs.pop('callback', None)
         return self.send(command.SubmitSM(**kwargs), cb)
+
+    def pipeline(self, messages, window=10, callback=None):
+        """Sends SubmitSM kwargs/commands keeping `window` of them in flight"""
+        return Pipeline(self, messages, window, callback).fill()
+
+
+class BasePool(object):
+    """Routes submits across several bound ESMEs"""
+    def __init__(self, window=10):
+        self.window = window
+        self.connections = []
+
+    def add(self, esme):
+        esme.on_deliver = lambda req, resp, reply: self.on_deliver(req, resp, reply)
+        self.connections.append(esme)
+        self._wake()
+
+    def remove(self, esme):
+        if esme in self.connections:
+            self.connections.remove(esme)
+
+    def pick(self):
+        """Returns the least loaded connection with a free window slot
+
+        Requests queued by the throttle count toward the load.
+        """
+        result = None
+        best = self.window
+        for esme in self.connections:
+            load = len(esme.in_flight) + len(esme.throttled)
+            if load < best:
+                result, best = esme, load
+        return result
+
+    def on_deliver(self, req, resp, reply):  # pragma: no cover
+        pass
+
+    def _wake(self):  # pragma: no cover
+        pass
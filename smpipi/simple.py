@@ -24,6 +24,11 @@ class ESME(BaseESME):
         self.closed = True
         self._socket.close()
 
+    def on_throttle(self, delay):
+        self.flush()
+        time.sleep(delay)
+        return True
+
     def wait_for(self, response, timeout=None):
         timeout and self.set_timeout(timeout)
         expire = time.time() + self._socket.gettimeout()
@@ -36,21 +41,38 @@ class ESME(BaseESME):
 
         return response.response
 
+    def submit_many(self, messages, window=10, timeout=None):
+        """Yields (request, response) pairs for submitted messages"""
+        timeout and self.set_timeout(timeout)
+        pipeline = self.pipeline(messages, window)
+        while True:
+            while pipeline.results:
+                yield pipeline.results.popleft()
+
+            if pipeline.done:
+                break
+
+            if not self.read(False):
+                raise Timeout()
+
     def read(self, timeout_result=True):
         if self.closed:
             return False
 
+        # requests sent from handlers inside feed() are still buffered
+        self.flush()
+
         try:
-            data = self._socket.recv(1024)
+            nbytes = self._socket.recv_into(self.receiver.get_buffer())
         except socket.timeout:
             return timeout_result
         except IOError:  # pragma: no cover
             return False
 
-        if not data:
+        if not nbytes:
             return False
 
-        self.feed(data)
+        self.feed(self.receiver.received(nbytes))
         return True
 
     def close(self):
@@ -1,13 +1,17 @@
 from struct import Struct
-from .packet import int8, int16, int32
+from .packet import int8, int16, int32, DecodeError
 from .compat import bytestr
 
 tlv_struct = Struct('!HH')
+TLV_HEADER = b'\x00' * tlv_struct.size
+
+ESME_RINVOPTPARSTREAM = 0x000000C0
+ESME_RINVPARLEN = 0x000000C2
 
 INT_TYPES = {
     1: int8,
     2: int16,
-    3: int32
+    4: int32
 }
 
 
@@ -15,34 +19,43 @@ class IntField(object):
     def __init__(self, name, size):
         self.name = name
         self.size = size
+        self.struct = INT_TYPES[size].struct
+        self.tlv_struct = Struct('!HH' + INT_TYPES[size].fmt.lstrip('!'))
 
-    def decode(self, size, value):
-        return INT_TYPES[size].decode(value, 0)[0]
+    def decode(self, buf, offset, size):
+        if size == self.size:
+            return self.struct.unpack_from(buf, offset)[0]
+        if size not in INT_TYPES:
+            raise DecodeError('invalid {} length {}'.format(self.name, size), ESME_RINVPARLEN)
+        return INT_TYPES[size].decode(buf, offset)[0]
 
-    def encode(self, value):
-        return INT_TYPES[self.size].encode(value)
+    def encode_into(self, buf, tag, value):
+        buf += self.tlv_struct.pack(tag, self.size, int(value or 0))
 
 
 class StrField(object):
     def __init__(self, name):
         self.name = name
 
-    def decode(self, size, value):
-        return value
+    def decode(self, buf, offset, size):
+        return buf[offset:offset + size]
 
-    def encode(self, value):
-        return bytestr(value)
+    def encode_into(self, buf, tag, value):
+        if type(value) is not bytes:
+            value = bytestr(value)
+        buf += tlv_struct.pack(tag, len(value))
+        buf += value
 
 
 class EmptyField(object):
     def __init__(self, name):
         self.name = name
 
-    def decode(self, size, value):
+    def decode(self, buf, offset, size):
         return ''
 
-    def encode(self, value):
-        return b''
+    def encode_into(self, buf, tag, value):
+        buf += tlv_struct.pack(tag, 0)
 
 
 NStrField = StrField
@@ -95,37 +108,85 @@ tags = {
     0x1383: StrField('its_session_info'),
 }
 
-names = {field.name: (tag, field) for tag, field in tags.items()}
+class Registry(object):
+    """TLV tags known to a connection, standard ones plus vendor `fields`
+
+    Every registry keeps its own merged tag dict, so vendor tags cost
+    nothing for standard tag lookups.
+    """
+    def __init__(self, fields=None, base=None):
+        self.tags = dict(base.tags if base else tags)
+        self.tags.update(fields or {})
+        self.names = {field.name: (tag, field) for tag, field in self.tags.items()}
+        self.tag_names = frozenset(self.names)
+        self.order = {name: tag for name, (tag, _) in self.names.items()}
+
+    def extend(self, fields):
+        """Returns new registry with additional `fields`"""
+        return Registry(fields, self)
+
+    def decode(self, buf, offset):
+        """Returns dict of TLV values, unknown tags go to `unknown_tlvs` as (tag, bytes) pairs"""
+        bufsize = len(buf)
+        result = {}
+        unpack = tlv_struct.unpack_from
+        get = self.tags.get
+        while offset < bufsize:
+            if offset + 4 > bufsize:
+                raise DecodeError('truncated TLV header', ESME_RINVOPTPARSTREAM)
+            tag, size = unpack(buf, offset)
+            offset += 4
+            if offset + size > bufsize:
+                raise DecodeError('truncated TLV {:#06x}'.format(tag), ESME_RINVOPTPARSTREAM)
+            field = get(tag)
+            if field is not None:
+                result[field.name] = field.decode(buf, offset, size)
+            else:
+                result.setdefault('unknown_tlvs', []).append((tag, buf[offset:offset + size]))
+            offset += size
+
+        return result, offset
+
+    def encode(self, data, exclude=()):
+        return bytes(self.encode_into(bytearray(), data, exclude))
+
+    def encode_into(self, buf, data, exclude=()):
+        keys = self.tag_names.intersection(data)
+        if exclude:
+            keys = keys.difference(exclude)
+        names = self.names
+        for k in sorted(keys, key=self.order.__getitem__):
+            tag, field = names[k]
+            field.encode_into(buf, tag, data[k])
+
+        unknown = data.get('unknown_tlvs')
+        if unknown and 'unknown_tlvs' not in exclude:
+            for tag, value in unknown:
+                buf += tlv_struct.pack(tag, len(value))
+                buf += value
 
+        return buf
 
-def decode(buf, offset):
-    bufsize = len(buf)
-    result = {}
-    while offset < bufsize:
-        tag, size = tlv_struct.unpack_from(buf, offset)
-        offset += tlv_struct.size
-        value = buf[offset:offset + size]
-        offset += size
 
-        field = tags.get(tag)
-        if field:
-            value = field.decode(size, value)
-            name = field.name
-        else:
-            name = '_tag_{}'.format(hex(tag))
+default = Registry()
+names = default.names
+decode = default.decode
+encode = default.encode
+encode_into = default.encode_into
 
-        result[name] = value
+profiles = {}
 
-    return result, offset
 
+def register_profile(name, fields, base=None):
+    """Registers a named registry with vendor `fields` for some SMSC"""
+    registry = profiles[name] = Registry(fields, base)
+    return registry
 
-def encode(data):
-    result = b''
-    for k, v in data.items():
-        if k in names:
-            tag, field = names[k]
-            value = field.encode(v)
-            size = len(value)
-            result += tlv_struct.pack(tag, size) + value
 
-    return result
+def get_registry(registry=None):
+    """Returns registry for a profile name, a registry or the default one for None"""
+    if registry is None:
+        return default
+    if isinstance(registry, Registry):
+        return registry
+    return profiles[registry]
@@ -6,10 +6,10 @@ import socket
 from tornado.tcpserver import TCPServer
 from tornado.iostream import IOStream, StreamClosedError
 from tornado.ioloop import IOLoop
-from tornado.gen import coroutine, sleep, Return
+from tornado.gen import coroutine, sleep, Return, WaitIterator
 from tornado.concurrent import Future
 
-from .proto import BaseConnection, BaseESME
+from .proto import BaseConnection, BaseESME, BasePool
 from . import command
 
 
@@ -17,14 +17,18 @@ class DeliverMixin(object):
     def _deliver(self, req, resp):
         reply = self._make_reply(resp)
         future = self.on_deliver(req, resp, reply)
-        self.ioloop.add_future(future, lambda _: reply.called or reply())
+        self.ioloop.add_future(future, lambda f: self._delivered(req, reply, f))
 
 
 class ESME(DeliverMixin, BaseESME):
+    tick_interval = 1
+
     def __init__(self, **kwargs):
         BaseESME.__init__(self, **kwargs)
         self.running = False
         self.closed = False
+        self._release_timer = None
+        self._read = None
 
     @coroutine
     def connect(self, host, port):
@@ -32,6 +36,12 @@ class ESME(DeliverMixin, BaseESME):
         self.ioloop = IOLoop.current()
         self.stream = IOStream(s)
         yield self.stream.connect((host, port))
+        self.ioloop.call_later(self.tick_interval, self._tick)
+
+    def _tick(self):
+        if not self.closed:
+            self.expire_requests()
+            self.ioloop.call_later(self.tick_interval, self._tick)
 
     def on_send(self, data):
         return self.stream.write(data)
@@ -40,19 +50,39 @@ class ESME(DeliverMixin, BaseESME):
         self.closed = True
         self.stream.close()
 
+    def on_throttle(self, delay):
+        if self._release_timer is None:
+            self._release_timer = self.ioloop.call_later(delay, self._release)
+
+    def _release(self):
+        self._release_timer = None
+        if not self.closed:
+            self.release()
+
     @coroutine
     def readloop(self, future):
         while not self.closed and (not future or not future.done()):
+            # a pending read survives until the next readloop when `future` wins
+            if self._read is None:
+                self._read = self.stream.read_bytes(self.receiver.size, partial=True)
+            if future:
+                yield WaitIterator(self._read, future).next()
+                if not self._read.done():
+                    continue
+
+            read, self._read = self._read, None
             try:
-                data = yield self.stream.read_bytes(1024, partial=True)
+                data = yield read
             except StreamClosedError:  # pragma: no cover
                 break
             else:
+                self.receiver.update(len(data))
                 self.feed(data)
 
     def wait_for(self, response):
         future = Future()
-        response.callback = lambda resp: future.set_result(resp.response)
+        response.callback = lambda resp: future.done() or future.set_result(resp.response)
+        response.on_timeout = lambda resp: future.done() or future.set_result(None)
         if self.running:
             return future
         else:
@@ -70,6 +100,86 @@ class ESME(DeliverMixin, BaseESME):
             raise Return(future.result())
 
 
+class ESMEPool(BasePool):
+    def __init__(self, host, port, system_id, password, size=2, mode='transceiver',
+                 window=10, reconnect_delay=5, **kwargs):
+        BasePool.__init__(self, window)
+        self.address = (host, port)
+        self.credentials = (system_id, password, mode)
+        self.size = size
+        self.reconnect_delay = reconnect_delay
+        self.kwargs = kwargs
+        self.stopped = False
+        self._slot = None
+
+    def start(self):
+        self.stopped = False
+        for _ in range(self.size):
+            IOLoop.current().add_future(self._keep(), lambda f: f.result())
+
+    @coroutine
+    def stop(self):
+        self.stopped = True
+        for esme in list(self.connections):
+            yield esme.wait_for(esme.unbind())
+            self.remove(esme)
+            esme.closed or esme.on_close()
+        self._wake()
+
+    @coroutine
+    def _keep(self):
+        system_id, password, mode = self.credentials
+        while not self.stopped:
+            esme = ESME(**self.kwargs)
+            try:
+                yield esme.connect(*self.address)
+                bind = getattr(esme, 'bind_' + mode)
+                resp = yield esme.wait_for(bind(system_id, password))
+                if resp and resp.command_status == 0 and not self.stopped:
+                    self.add(esme)
+                    yield esme.run()
+            except (IOError, StreamClosedError):
+                pass
+            finally:
+                self.remove(esme)
+                if not esme.closed:
+                    esme.on_close()
+
+            if not self.stopped:
+                yield sleep(self.reconnect_delay)
+
+    def _wake(self):
+        if self._slot is not None and not self._slot.done():
+            self._slot.set_result(None)
+
+    @coroutine
+    def wait_slot(self):
+        while not self.stopped and not self.pick():
+            if self._slot is None or self._slot.done():
+                self._slot = Future()
+            yield self._slot
+
+    @coroutine
+    def submit(self, **kwargs):
+        # another submit may take the slot before this coroutine resumes
+        esme = None
+        while esme is None and not self.stopped:
+            yield self.wait_slot()
+            esme = self.pick()
+        if esme is None:
+            raise Return(None)
+
+        try:
+            resp = yield esme.wait_for(esme.send_message(**kwargs))
+        finally:
+            self._wake()
+        raise Return(resp)
+
+    @coroutine
+    def on_deliver(self, req, resp, reply):  # pragma: no cover
+        pass
+
+
 class Server(TCPServer):  # pragma: no cover
     def __init__(self, ioloop, stream_handler):
         TCPServer.__init__(self, ioloop)
@@ -116,10 +226,11 @@ class TestSMSC(DeliverMixin, BaseConnection):  # pragma: no cover
                 yield sleep(2)
 
             try:
-                data = yield self.stream.read_bytes(1024, partial=True)
+                data = yield self.stream.read_bytes(self.receiver.size, partial=True)
             except StreamClosedError:
                 break
             else:
+                self.receiver.update(len(data))
                 self.feed(data)
 
         self.stream.close()
@@ -1,49 +1,367 @@
-from asyncio import coroutine, get_event_loop
+import asyncio
+from asyncio import gather, get_event_loop
+from types import SimpleNamespace
 
-from smpipi.asyncio import ESME
+from smpipi import command
+from smpipi.asyncio import ESME, ESMEPool, Server
+from smpipi.proto import CommandError, Proto
 
 
 def async_run(func):
     ioloop = get_event_loop()
-    work = coroutine(func)
-    ioloop.run_until_complete(work())
+    ioloop.run_until_complete(func())
 
 
 def test_bind(smsc):
     @async_run
-    def work():
+    async def work():
         esme = ESME()
-        yield from esme.connect('127.0.0.1', 30001)
-        resp = yield from esme.wait_for(esme.bind_transceiver('boo', 'foo'))
+        await esme.connect('127.0.0.1', 30001)
+        resp = await esme.wait_for(esme.bind_transceiver('boo', 'foo'))
+        assert resp.command_status == 0
+        resp = await esme.bind('boo', 'foo', 'transmitter')
         assert resp.command_status == 0
         esme.send_message(short_message='close')
-        yield from esme.run()
+        await esme.run()
+
+
+def test_submit(smsc):
+    @async_run
+    async def work():
+        esme = ESME()
+        await esme.connect('127.0.0.1', 30001)
+        resp = await esme.submit(short_message='boo')
+        assert resp.command_status == 0
+
+        results = await esme.submit_many([{'short_message': 'boo'}] * 20, 5)
+        assert len(results) == 20
+        assert all(resp.command_status == 0 for _, resp in results)
+
+        results = []
+        async for req, resp in esme.submit_iter([{'short_message': 'boo'}] * 7, 3):
+            results.append((req.sequence_number, resp.command_status))
+        assert sorted(results) == [(seq, 0) for seq in range(22, 29)]
+
+        async def messages():
+            for i in range(5):
+                await asyncio.sleep(0.01)
+                yield command.SubmitSM(short_message=str(i))
+
+        results = []
+        async for req, resp in esme.submit_iter(messages(), 2):
+            results.append((req.short_message, resp.command_status))
+        assert sorted(results) == [(str(i), 0) for i in range(5)]
+
+        esme.send_message(short_message='close')
+        await esme.run()
+
+
+def test_throttle(smsc):
+    @async_run
+    async def work():
+        esme = ESME(tps=20, burst=1)
+        await esme.connect('127.0.0.1', 30001)
+        start = esme.loop.time()
+        resps = [esme.send_message(short_message='boo') for _ in range(3)]
+        assert len(esme.throttled) == 2
+        for resp in resps:
+            assert (await esme.wait_for(resp)).command_status == 0
+        assert esme.loop.time() - start >= 0.09
+        assert not esme.throttled
 
 
 def test_delivery(smsc):
     @async_run
-    def work():
-        @coroutine
-        def deliver(request, response, reply):
+    async def work():
+        async def deliver(request, response, reply):
             assert request.short_message == b'foo'
             reply()
-            resp = yield from esme.wait_for(esme.send_message(short_message='close'))
+            resp = await esme.wait_for(esme.send_message(short_message='close'))
             assert resp.command_status == 0
 
         esme = ESME()
         esme.on_deliver = deliver
-        yield from esme.connect('127.0.0.1', 30001)
+        await esme.connect('127.0.0.1', 30001)
         esme.send_message(short_message='deliver foo')
-        yield from esme.run()
+        await esme.run()
 
 
 def test_broken_wait(smsc):
     @async_run
-    def work():
+    async def work():
         esme = ESME()
-        yield from esme.connect('127.0.0.1', 30001)
-        yield from esme.wait_for(esme.send_message(short_message='disconnect'))
+        await esme.connect('127.0.0.1', 30001)
+        await esme.wait_for(esme.send_message(short_message='disconnect'))
 
         resp = esme.send_message(short_message='boo')
-        yield from esme.wait_for(resp)
+        await esme.wait_for(resp)
         assert not resp.ready
+
+
+def test_pool(smsc):
+    @async_run
+    async def work():
+        pool = ESMEPool('127.0.0.1', 30001, 'boo', 'foo', size=3, window=2)
+        pool.start()
+        results = await gather(*[pool.submit(short_message='boo') for _ in range(20)])
+        assert all(resp.command_status == 0 for resp in results)
+        assert len(pool.connections) == 3
+        await pool.stop()
+        assert not pool.connections
+        assert await pool.submit(short_message='boo') is None
+
+
+def test_pool_reconnect():
+    @async_run
+    async def work():
+        server = await get_event_loop().create_server(asyncio.Protocol, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        server.close()
+        await server.wait_closed()
+
+        pool = ESMEPool('127.0.0.1', port, 'boo', 'foo', size=2, reconnect_delay=0.01)
+        pool.start()
+        await asyncio.sleep(0.05)
+        assert not pool.connections
+        await pool.stop()
+
+
+def test_lazy_deliver_decode_error():
+    sent = []
+    esme = ESME(lazy=True)
+    esme.loop = get_event_loop()
+    esme.transport = SimpleNamespace(write=sent.append)
+
+    async def on_deliver(req, resp, reply):
+        assert req.short_message
+
+    esme.on_deliver = on_deliver
+    bad = command.header_struct.pack(20, command.DeliverSM.command_id, 0, 3) + b'boo!'
+    esme.feed(bad + command.DeliverSM(sequence_number=4, short_message='boo').encode())
+    esme.loop.run_until_complete(asyncio.sleep(0.01))
+
+    statuses = [(c.command_id, c.sequence_number, c.command_status)
+                for c in Proto().receive_bytes(b''.join(map(bytes, sent)))]
+    assert statuses == [(command.GenericNack.command_id, 3, command.ESME_RINVCMDLEN),
+                        (command.DeliverSMResp.command_id, 4, 0)]
+
+
+def test_pipeline_drain():
+    esme = ESME()
+    esme.loop = get_event_loop()
+    esme.transport = SimpleNamespace(write=lambda data: None)
+
+    esme.pause_writing()
+    pipeline = esme.pipeline([{'short_message': 'boo'}] * 4, 2)
+    assert esme.sequence_number == 0
+
+    esme.resume_writing()
+    assert pipeline.in_flight == 2
+    assert esme.sequence_number == 2
+
+    esme.pause_writing()
+    esme.feed(command.SubmitSMResp(sequence_number=1).encode())
+    assert pipeline.in_flight == 1
+    assert esme.sequence_number == 2
+
+    esme.resume_writing()
+    assert pipeline.in_flight == 2
+    assert esme.sequence_number == 3
+
+
+def test_drain_and_tick():
+    @async_run
+    async def work():
+        sent = []
+        esme = ESME(response_timeout=0.05)
+        esme.loop = get_event_loop()
+        esme.done = esme.loop.create_future()
+        esme.tick_interval = 0.01
+        esme.connection_made(SimpleNamespace(write=lambda data: sent.append(bytes(data))))
+
+        def written():
+            return [c.sequence_number for c in Proto().receive_bytes(b''.join(sent))]
+
+        def respond(seq):
+            esme.feed(command.SubmitSMResp(sequence_number=seq, message_id='id').encode())
+
+        esme.pause_writing()
+        task = asyncio.ensure_future(esme.submit(short_message='boo'))
+        await asyncio.sleep(0.001)
+        assert written() == [1]
+        assert not task.done()
+        esme.resume_writing()
+        respond(1)
+        resp = await task
+        assert resp.message_id == b'id'
+
+        esme.pause_writing()
+        task = asyncio.ensure_future(esme.submit_many([{'short_message': 'boo'}] * 2, 1))
+        await asyncio.sleep(0.001)
+        assert written() == [1]
+        esme.resume_writing()
+        assert written() == [1, 2]
+        esme.pause_writing()
+        respond(2)
+        await asyncio.sleep(0.001)
+        assert written() == [1, 2]
+        esme.resume_writing()
+        assert written() == [1, 2, 3]
+        respond(3)
+        assert len(await task) == 2
+
+        stream = esme.submit_iter([{'short_message': 'boo'}] * 3, 2)
+        task = asyncio.ensure_future(stream.__anext__())
+        await asyncio.sleep(0.001)
+        respond(4)
+        req, resp = await task
+        assert req.sequence_number == 4
+        esme.pause_writing()
+        task = asyncio.ensure_future(stream.__anext__())
+        await asyncio.sleep(0.001)
+        respond(5)
+        assert written() == [1, 2, 3, 4, 5]
+        esme.resume_writing()
+        req, resp = await task
+        assert req.sequence_number == 5
+        assert written() == [1, 2, 3, 4, 5, 6]
+        respond(6)
+        assert [req.sequence_number async for req, resp in stream] == [6]
+
+        resp = esme.send_message(short_message='late')
+        assert await esme.run(resp) is None
+        assert resp.timed_out
+
+        esme.connection_lost(None)
+        assert esme._future().done()
+        await esme.run()
+
+
+class SMSC(Server):
+    async def authenticate(self, session, cmd):
+        if cmd.password == b'none':
+            return None
+        if cmd.password == b'lock':
+            raise CommandError(0x0E)
+        return command.ESME_ROK if cmd.password == b'foo' else 0x0E
+
+    async def on_submit(self, session, cmd):
+        if cmd.short_message == b'wait':
+            await self.release.wait()
+        if cmd.short_message == b'bad':
+            raise CommandError(0x0B)
+        if cmd.short_message == b'crash':
+            raise ValueError('crash')
+        return b'id-' + cmd.short_message
+
+    def on_request(self, session, cmd):
+        if cmd.message_id == b'id-known':
+            return command.QuerySMResp(message_id=cmd.message_id, message_state=2)
+        if cmd.message_id == b'id-crash':
+            raise ValueError('crash')
+
+
+def test_server():
+    @async_run
+    async def work():
+        smsc = SMSC(window=2)
+        smsc.release = asyncio.Event()
+        server = await smsc.start('127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+
+        esme = ESME()
+        await esme.connect('127.0.0.1', port)
+        resp = await esme.submit(short_message='boo')
+        assert resp.command_status == command.ESME_RINVBNDSTS
+
+        resp = await esme.bind('boo', 'bar')
+        assert resp.command_status == 0x0E
+        resp = await esme.bind('boo', 'foo')
+        assert resp.command_status == 0
+        assert resp.system_id == b'smpipi'
+        resp = await esme.bind('boo', 'foo')
+        assert resp.command_status == command.ESME_RALYBND
+
+        resp = await esme.submit(short_message='boo')
+        assert resp.message_id == b'id-boo'
+        resp = await esme.submit(short_message='bad')
+        assert resp.command_status == 0x0B
+
+        waiting = [esme.send_message(short_message='wait') for _ in range(3)]
+        resp = await esme.wait_for(waiting[2])
+        assert resp.command_status == command.ESME_RTHROTTLED
+        smsc.release.set()
+        resp = await esme.wait_for(waiting[1])
+        assert resp.message_id == b'id-wait'
+
+        resp = await esme.request(command.QuerySM(message_id='id-boo'))
+        assert resp.command_status == command.ESME_RINVCMDID
+
+        delivered = []
+
+        async def on_deliver(req, resp, reply):
+            delivered.append(req.short_message)
+
+        esme.on_deliver = on_deliver
+        resp = smsc.deliver('boo', short_message='hello')
+        smsc.pick('boo').deliver_many([{'short_message': 'world'}])
+        await esme.wait_for(esme.send(command.EnquireLink()))
+        assert delivered == [b'hello', b'world']
+        await asyncio.sleep(0.01)
+        assert resp.ready
+
+        await esme.wait_for(esme.unbind())
+        await asyncio.sleep(0.01)
+        assert not smsc.bound
+        assert smsc.deliver('boo', short_message='hello') is None
+        await smsc.stop()
+
+
+def test_server_errors():
+    @async_run
+    async def work():
+        smsc = SMSC(tick_interval=0.01, response_timeout=0.05)
+        server = await smsc.start('127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+
+        esme = ESME()
+        await esme.connect('127.0.0.1', port)
+        resp = await esme.bind('boo', 'none')
+        assert resp.command_status == command.ESME_RBINDFAIL
+        resp = await esme.bind('boo', 'lock')
+        assert resp.command_status == 0x0E
+        resp = await esme.bind('boo', 'foo')
+        assert resp.command_status == 0
+
+        resp = await esme.submit(short_message='crash')
+        assert resp.command_status == command.ESME_RSYSERR
+        resp = await esme.request(command.QuerySM(message_id='id-known'))
+        assert resp.command_status == 0
+        assert resp.message_state == 2
+        resp = await esme.request(command.QuerySM(message_id='id-crash'))
+        assert resp.command_status == command.ESME_RSYSERR
+        bad = command.header_struct.pack(20, command.SubmitSM.command_id, 0, 99)
+        esme.transport.write(bad + b'boo!')
+        resp = await esme.wait_for(esme.send(command.EnquireLink()))
+        assert resp.command_status == 0
+
+        session = smsc.pick('boo')
+        assert session.receiver is smsc.receiver
+        esme.on_deliver = lambda req, resp, reply: asyncio.Event().wait()
+        resp = smsc.deliver('boo', short_message='hang')
+        await asyncio.sleep(0.2)
+        assert resp.timed_out
+        assert not session.in_flight
+
+        async def crash(req, resp, reply):
+            raise ValueError('crash')
+
+        esme.on_deliver = crash
+        resp = smsc.deliver('boo', short_message='crash')
+        await asyncio.sleep(0.05)
+        assert resp.ready and resp.response.command_status == 0
+
+        await smsc.stop()
+        await asyncio.wait_for(esme.done, 1)
+        assert session.closed
+        assert not smsc.sessions
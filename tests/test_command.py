@@ -1,4 +1,9 @@
+import copy
+import pickle
+
+import pytest
 from binascii import unhexlify
+from smpipi import command
 from smpipi.command import Command, EnquireLink, SubmitSM
 from smpipi import tlv
 
@@ -35,12 +40,20 @@ def test_tlv_encode():
     assert cmd.dest_addr_subunit == 1
     assert cmd.alert_on_message_delivery == ''
 
+    cmd = Command.decode(SubmitSM(qos_time_to_live=70000, source_port=2).encode())
+    assert cmd.qos_time_to_live == 70000
+    assert cmd.source_port == 2
+
 
 def test_unknown_tlv():
     data = tlv.encode({'dest_addr_subunit': '1'})
     data = b'\x42\x42' + data[2:]
     result, _ = tlv.decode(data, 0)
-    assert result == {'_tag_0x4242': b'\x01'}
+    assert result == {'unknown_tlvs': [(0x4242, b'\x01')]}
+
+    cmd = Command.decode(SubmitSM(sequence_number=1).encode() + data)
+    assert cmd.unknown_tlvs == [(0x4242, b'\x01')]
+    assert cmd.encode().endswith(data)
 
 
 def test_size_field_encode():
@@ -48,3 +61,208 @@ def test_size_field_encode():
     cmd = Command.decode(cmd.encode())
     assert cmd.sm_length == 3
     assert cmd.short_message == b'boo'
+
+
+def test_lazy_decode():
+    payload = SubmitSM(short_message='boo', sequence_number=3,
+                       its_session_info='foo').encode()
+    cmd = Command.decode(payload, lazy=True)
+    assert sorted(dict.keys(cmd)) == ['command_id', 'command_length',
+                                      'command_status', 'sequence_number']
+    assert cmd.sequence_number == 3
+    assert cmd._pending
+
+    cmd.sm_length = 10
+    assert cmd.short_message == b'boo'
+    assert cmd.its_session_info == b'foo'
+    assert cmd.sm_length == 10
+
+    with pytest.raises(KeyError):
+        cmd.boo
+
+    assert Command.decode(cmd.encode()).short_message == b'boo'
+
+    cmd = Command.decode(payload, lazy=True)
+    assert Command.decode(cmd.encode()) == Command.decode(payload)
+
+    cmd = Command.decode(EnquireLink().encode(), lazy=True)
+    with pytest.raises(KeyError):
+        cmd.boo
+
+
+def test_template():
+    fixed = dict(source_addr='boo', source_addr_ton=5, registered_delivery=1,
+                 data_coding=8, its_session_info='foo')
+    template = SubmitSM.template(('destination_addr', 'dest_addr_ton', 'sm_length'),
+                                 **fixed)
+    assert len(template.segments) == 5
+
+    fields = dict(destination_addr='123', dest_addr_ton=1, short_message='bar',
+                  sequence_number=42, ussd_service_op='1')
+    payload = template.encode(**fields)
+    expected = SubmitSM(**dict(fixed, **fields))
+    assert Command.decode(payload) == Command.decode(expected.encode())
+
+    cmd = template.make(**fields)
+    assert cmd.encode() == payload
+    assert cmd.command_length == len(payload)
+
+    buf = bytearray(b'xx')
+    template.encode_into(buf, cmd)
+    assert buf[2:] == payload
+
+    cmd.source_addr = 'foo'
+    assert Command.decode(cmd.encode()).source_addr == b'foo'
+    cmd = template.make(registered_delivery=0, **fields)
+    assert Command.decode(cmd.encode()).registered_delivery == 0
+    assert Command.decode(template.encode(data_coding=0, **fields)).data_coding == 0
+
+    assert EnquireLink.template().encode(sequence_number=1) == \
+        EnquireLink(sequence_number=1).encode()
+
+    template = SubmitSM.template(unknown_tlvs=[(0x1500, b'x')])
+    cmd = Command.decode(template.make(short_message='boo').encode())
+    assert cmd.unknown_tlvs == [(0x1500, b'x')]
+
+
+def test_copy_and_pickle():
+    template = SubmitSM.template(('short_message',), source_addr='boo')
+    data = SubmitSM(short_message='boo').encode()
+    for cmd in (SubmitSM(short_message='boo', sequence_number=2),
+                Command.decode(data),
+                Command.decode(data, lazy=True).load(),
+                template.make(short_message='foo'),
+                Command.decode(data, compact=True),
+                Command.decode(data, lazy=True, compact=True)):
+        payload = cmd.encode()
+        for result in (copy.copy(cmd), copy.deepcopy(cmd),
+                       pickle.loads(pickle.dumps(cmd, 2))):
+            assert type(result) is type(cmd)
+            assert result == cmd
+            assert result.encode() == payload
+            assert not result._template
+
+    compact = type(Command.decode(data, compact=True))
+    assert compact.__name__ == 'CompactSubmitSM'
+    assert pickle.loads(pickle.dumps(compact)) is compact
+
+    with pytest.raises(AttributeError):
+        SubmitSM().__deepcopy__
+
+    cmd = Command.decode(data, lazy=True)
+    assert getattr(cmd, '__deepcopy__', None) is None
+    assert cmd._pending
+    for result in (copy.deepcopy(cmd), pickle.loads(pickle.dumps(cmd, 2))):
+        assert not result._pending
+        assert result.short_message == b'boo'
+
+
+def test_encode_into():
+    buf = bytearray(b'xx')
+    cmd = SubmitSM(short_message='boo', its_session_info='foo', sequence_number=1)
+    assert cmd.encode_into(buf) is buf
+    assert buf[2:] == cmd.encode()
+    assert Command.decode(bytes(buf[2:])).its_session_info == b'foo'
+
+    data = tlv.encode({'dest_addr_subunit': 1, 'boo': 2})
+    assert data == b'\x00\x05\x00\x01\x01'
+
+
+def test_compact_decode():
+    payload = SubmitSM(short_message='boo', sequence_number=3,
+                       its_session_info='foo').encode()
+    cmd = Command.decode(payload, compact=True)
+    assert not isinstance(cmd, dict)
+    assert cmd == Command.decode(payload)
+    assert cmd.short_message == cmd['short_message'] == b'boo'
+    assert cmd.its_session_info == b'foo'
+    assert cmd.get('sar_msg_ref_num') is None
+    assert 'its_session_info' in cmd and 'boo' not in cmd
+    assert cmd.encode() == payload
+
+    cmd['text'] = 'boo'
+    cmd.update(sequence_number=4)
+    assert cmd.text == 'boo'
+    assert cmd.sequence_number == 4
+    assert cmd.pop('text') == 'boo'
+    with pytest.raises(AttributeError):
+        cmd.text
+
+    cmd = Command.decode(payload, lazy=True, compact=True)
+    cmd.sm_length = 10
+    assert cmd.short_message == b'boo'
+    assert cmd.sm_length == 10
+    assert Command.decode(EnquireLink().encode(), compact=True) == EnquireLink(
+        command_length=16, command_status=0, sequence_number=0)
+
+
+def test_compact_mapping():
+    cmd = SubmitSM.compact_type()(short_message='boo', sequence_number=3, text='foo')
+    assert cmd.items() == [('command_id', 4), ('sequence_number', 3),
+                           ('short_message', 'boo'), ('text', 'foo')]
+    assert cmd.values() == [4, 3, 'boo', 'foo']
+    assert cmd != SubmitSM(short_message='boo')
+    assert SubmitSM(short_message='boo') != cmd
+
+    del cmd['short_message']
+    del cmd['text']
+    assert 'short_message' not in cmd and 'text' not in cmd
+    with pytest.raises(KeyError):
+        del cmd['short_message']
+
+    assert cmd.pop('text', None) is None
+    assert cmd.pop('short_message', 'boo') == 'boo'
+    with pytest.raises(KeyError):
+        cmd.pop('text')
+    assert cmd.pop('sequence_number') == 3
+    assert cmd.keys() == ['command_id']
+
+
+def test_tlv_registry():
+    registry = tlv.register_profile('test-smsc', {
+        0x1401: tlv.IntField('vendor_status', 2),
+        0x1402: tlv.StrField('vendor_ref'),
+    })
+    assert tlv.get_registry('test-smsc') is registry
+    assert tlv.get_registry() is tlv.default
+
+    cmd = SubmitSM(vendor_status=513, vendor_ref='abc', source_port=1, sequence_number=1)
+    payload = cmd.encode(registry)
+    assert len(payload) == len(cmd.encode()) + 13
+
+    result = Command.decode(payload, registry=registry)
+    assert result.vendor_status == 513
+    assert result.vendor_ref == b'abc'
+    assert result.source_port == 1
+
+    result = Command.decode(payload, lazy=True, compact=True, registry=registry)
+    assert result.vendor_ref == b'abc'
+
+    result = Command.decode(payload)
+    assert result.unknown_tlvs == [(0x1401, b'\x02\x01'), (0x1402, b'abc')]
+    assert 'vendor_ref' not in tlv.default.names
+
+    extended = registry.extend({0x1403: tlv.StrField('vendor_tag')})
+    cmd.vendor_tag = 'x'
+    result = Command.decode(cmd.encode(extended), registry=extended)
+    assert (result.vendor_status, result.vendor_ref, result.vendor_tag) == (513, b'abc', b'x')
+    assert 'vendor_tag' not in registry.names
+
+
+def test_malformed_decode():
+    def pdu(body):
+        return command.header_struct.pack(16 + len(body), SubmitSM.command_id, 0, 1) + body
+
+    def status(body):
+        with pytest.raises(command.DecodeError) as e:
+            Command.decode(pdu(body))
+        return e.value.command_status
+
+    body = SubmitSM(short_message='boo').encode()[16:]
+    assert status(b'\x00') == command.ESME_RINVCMDLEN
+    assert status(body[:-2]) == command.ESME_RINVCMDLEN
+    assert status(body + b'\x02') == command.ESME_RINVOPTPARSTREAM
+    assert status(body + b'\x02\x04\x00\x03abc') == command.ESME_RINVPARLEN
+
+    cmd = Command.decode(pdu(body + b'\x02\x04\x00\x01\x05'))
+    assert cmd.user_message_reference == 5
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from smpipi import command, gsm
+from smpipi.concat import Reassembler, parse_udh
+
+
+def deliver(short_message, **kwargs):
+    cmd = command.DeliverSM(short_message=short_message, source_addr='boo', **kwargs)
+    return command.Command.decode(cmd.encode())
+
+
+def test_parse_udh():
+    assert parse_udh(b'') == (None, 1, 1, b'')
+    assert parse_udh(b'\x05\x00\x03\x2a\x02\x01boo') == (42, 2, 1, b'boo')
+    assert parse_udh(b'\x06\x08\x04\x01\x2a\x02\x02boo') == (298, 2, 2, b'boo')
+    assert parse_udh(b'\x06\x05\x04\x0b\x84\x23\xf0boo') == (None, 1, 1, b'boo')
+    assert parse_udh(b'\x05\x00\x03\x2a') == (None, 1, 1, b'')
+
+
+def test_reassemble_udh():
+    text = u'boo{}' * 40
+    parts, encoding, esm_class = gsm.make_parts(text)
+    cmds = [deliver(p, esm_class=esm_class, data_coding=encoding) for p in parts]
+
+    r = Reassembler()
+    assert r.feed(cmds[1]) is None
+    assert r.feed(cmds[1]) is None
+    cmd = r.feed(cmds[0])
+    assert cmd.text == text
+    assert not r.pending
+
+
+def test_reassemble_sar():
+    text = u'б' * 100
+    cmds = [deliver(c.short_message, sar_msg_ref_num=c.sar_msg_ref_num,
+                    sar_total_segments=c.sar_total_segments,
+                    sar_segment_seqnum=c.sar_segment_seqnum, data_coding=8)
+            for c in gsm.make_submits(text, mode='sar')]
+    r = Reassembler()
+    assert r.feed(cmds[0]) is None
+    assert r.feed(cmds[1]).text == text
+
+
+def test_single_messages():
+    r = Reassembler()
+    assert r.feed(deliver(b'boo')).text == u'boo'
+    assert r.feed(deliver(b'\x00\x01', data_coding=4)).text is None
+    assert r.feed(deliver(b'\x00', data_coding=8)).text is None
+    cmd = r.feed(deliver(b'\x05\x00\x03\x2a\x02\x03boo', esm_class=0x40))
+    assert cmd.message == b'boo'
+
+
+def test_bounded_pending():
+    r = Reassembler(timeout=10, max_messages=2)
+    for ref in range(3):
+        r.feed(deliver(b'\x05\x00\x03' + bytes(bytearray([ref])) + b'\x02\x01boo',
+                       esm_class=0x40), now=100 + ref)
+    assert [key[1] for key in r.pending] == [1, 2]
+
+    r.expire(111)
+    assert [key[1] for key in r.pending] == [2]
+    r.expire(112)
+    assert not r.pending
@@ -0,0 +1,66 @@
+from smpipi import command, dlr
+
+TEXT = (b'id:0123456789 sub:001 dlvrd:001 submit date:1610181200 '
+        b'done date:1610181201 stat:DELIVRD err:000 text:Hello world')
+
+
+def deliver(**kwargs):
+    return command.DeliverSM(source_addr='123', **kwargs).encode()
+
+
+def test_parse_text():
+    cmd = command.Command.decode(deliver(esm_class=4, short_message=TEXT))
+    receipt = dlr.parse(cmd)
+    assert receipt == dlr.Receipt(
+        id=b'0123456789', stat=b'DELIVRD', err=b'000', sub=b'001', dlvrd=b'001',
+        submit_date=b'1610181200', done_date=b'1610181201', text=b'Hello world',
+        state=None)
+
+
+def test_parse_tlv():
+    cmd = command.Command.decode(deliver(esm_class=4, receipted_message_id='42\x00',
+                                         message_state=5))
+    receipt = dlr.parse(cmd)
+    assert receipt.id == b'42'
+    assert receipt.stat == b'UNDELIV'
+    assert receipt.state == 5
+    assert receipt.err is None
+
+
+def test_not_receipt():
+    assert dlr.parse(command.Command.decode(deliver(short_message=TEXT))) is None
+    assert dlr.parse(command.SubmitSM(esm_class=4)) is None
+    assert dlr.parse_pdu(deliver(short_message=TEXT)) is None
+    assert dlr.parse_pdu(command.EnquireLink().encode()) is None
+
+
+def test_parse_lazy_and_bulk():
+    pdu = deliver(esm_class=4, short_message=TEXT)
+    assert dlr.is_receipt_pdu(pdu)
+    assert dlr.peek_esm_class(deliver(esm_class=0x44)) == 0x44
+
+    cmd = command.Command.decode(pdu, lazy=True)
+    assert dlr.parse(cmd).stat == b'DELIVRD'
+
+    items = [pdu, deliver(short_message=b'boo'), command.Command.decode(pdu),
+             deliver(esm_class=4, short_message=b'garbage')]
+    receipts = list(dlr.parse_many(items))
+    assert [r.id for r in receipts] == [b'0123456789', b'0123456789', None]
+
+    cmd = command.Command.decode(deliver(short_message=TEXT), lazy=True)
+    assert not dlr.is_receipt(cmd)
+    assert cmd._pending
+    cmd = command.Command.decode(pdu, lazy=True, compact=True)
+    assert dlr.is_receipt(cmd)
+    assert cmd._pending
+
+
+def test_parse_malformed():
+    header = command.header_struct.pack(46, command.DeliverSM.command_id, 0, 1)
+    bad = [header + b'x' * 30, header + b'\x00\x00\x00', b'\x00\x00',
+           header + b'\x00\x00\x00\x00\x00\x00\x00']
+    errors = []
+    receipts = dlr.parse_many(bad + [deliver(esm_class=4, short_message=TEXT)],
+                              on_error=lambda item, e: errors.append(e.command_status))
+    assert [r.id for r in receipts] == [b'0123456789']
+    assert errors == [command.ESME_RINVCMDLEN] * 4
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 import pytest
-from smpipi import gsm
+from smpipi import gsm, command
 
 
 def test_latin_encode():
@@ -37,3 +37,120 @@ def test_cyrillic_parts():
 def test_too_long_parts():
     with pytest.raises(gsm.MessageTooLong):
         gsm.make_parts('a' * (160 * 256))
+
+
+def test_gsm_table():
+    assert gsm.is_gsm(u'boo{€}@')
+    assert not gsm.is_gsm(u'boo Б')
+    assert gsm.gsm_encode(u'@£{€}`') == b'\x00\x01\x1b(\x1be\x1b)_'
+    assert gsm.gsm_encode(u'boo', hex=True) == b'626f6f'
+    assert gsm.gsm_encode(b'boo') == b'boo'
+    assert gsm.is_gsm(b'boo')
+    with pytest.raises(gsm.EncodeError):
+        gsm.gsm_encode(u'Б')
+
+
+def test_decode():
+    text = u'@£$ abc ^{}\\[~]|€ ÄÖÑÜ`¿äöñüà'
+    assert gsm.decode(gsm.gsm_encode(text), 0) == text
+    assert gsm.decode(b'boo\x1b', 0) == u'boo'
+    assert gsm.decode(b'\x1bA\x1b', 0) == u'A'
+    assert gsm.decode(u'Бу'.encode('utf-16-be'), 8) == u'Бу'
+    assert gsm.decode(b'caf\xe9', 3) == u'café'
+
+
+def test_pack7():
+    assert gsm.pack7(b'hellohello') == b'\xe82\x9b\xfdF\x97\xd9\xec7'
+    assert gsm.unpack7(b'\xe82\x9b\xfdF\x97\xd9\xec7') == b'hellohello'
+    assert gsm.pack7(b'') == b''
+    assert gsm.unpack7(b'') == b''
+
+    data = gsm.gsm_encode(u'boo{}' * 50)
+    for fill in range(7):
+        packed = gsm.pack7(data, fill)
+        assert len(packed) == (len(data) * 7 + fill + 7) // 8
+        assert gsm.unpack7(packed, len(data), fill) == data
+
+    assert gsm.udh_fill_bits(6) == 1
+    assert gsm.udh_fill_bits(7) == 0
+
+
+def test_packed_parts():
+    parts, encoding, cls = gsm.make_parts(u'hellohello', packed=True)
+    assert parts == (b'\xe82\x9b\xfdF\x97\xd9\xec7',)
+
+    text = u'boo' * 100
+    parts, encoding, cls = gsm.make_parts(text, packed=True)
+    assert len(parts) == 2
+    assert max(len(p) for p in parts) == 140
+    data = b''.join(gsm.unpack7(p[6:], fill=1) for p in parts)
+    assert gsm.gsm_decode(data) == text
+
+
+def test_parts_keep_escapes():
+    text = u'a' * 152 + u'€' + u'b' * 10
+    parts, encoding, cls = gsm.make_parts(text)
+    assert [len(p) for p in parts] == [6 + 152, 6 + 12]
+    assert gsm.gsm_decode(b''.join(p[6:] for p in parts)) == text
+    assert gsm.count_parts(text) == (2, 0)
+
+
+def test_parts_keep_surrogates():
+    text = u'б' * 66 + u'\U0001F600' + u'б' * 10
+    parts, encoding, cls = gsm.make_parts(text)
+    assert [len(p) for p in parts] == [6 + 132, 6 + 24]
+    assert b''.join(p[6:] for p in parts).decode('utf-16-be') == text
+    assert gsm.count_parts(text) == (2, 8)
+
+    parts, _, _ = gsm.make_parts(u'\U0001F600' * 35)
+    assert parts == (u'\U0001F600'.encode('utf-16-be') * 35,)
+    assert gsm.count_parts(u'\U0001F600' * 36) == (2, 8)
+
+
+def test_ref16_parts():
+    parts, encoding, cls = gsm.make_parts(u'boo' * 100, ref16=True)
+    assert [len(p) for p in parts] == [7 + 152, 7 + 148]
+    assert parts[0][:3] == b'\x06\x08\x04'
+    assert parts[0][3:5] == parts[1][3:5]
+    assert parts[0][5:7] == b'\x02\x01'
+    assert parts[1][5:7] == b'\x02\x02'
+    assert gsm.count_parts(u'boo' * 100, ref16=True) == (2, 0)
+    assert gsm.count_parts(u'boo') == (1, 0)
+
+
+def decoded_submits(text, **kwargs):
+    result = []
+    for cmd in gsm.make_submits(text, source_addr='boo', destination_addr='123',
+                                registered_delivery=1, **kwargs):
+        payload = cmd.encode()
+        assert payload == command.SubmitSM(**cmd).encode()
+        result.append(command.Command.decode(payload))
+    return result
+
+
+def test_make_submits():
+    text = u'boo' * 100
+    cmds = decoded_submits(text)
+    assert len(cmds) == 2
+    assert all(c.esm_class == 0x40 and c.data_coding == 0 for c in cmds)
+    assert all(c.destination_addr == b'123' for c in cmds)
+    assert gsm.gsm_decode(b''.join(c.short_message[6:] for c in cmds)) == text
+
+    cmds = decoded_submits(text, mode='sar', esm_class=3)
+    assert [len(c.short_message) for c in cmds] == [160, 140]
+    assert [c.sar_segment_seqnum for c in cmds] == [1, 2]
+    assert {c.sar_total_segments for c in cmds} == {2}
+    assert len({c.sar_msg_ref_num for c in cmds}) == 1
+    assert {c.esm_class for c in cmds} == {3}
+
+    cmd, = decoded_submits(u'буу' * 100, mode='payload')
+    assert cmd.short_message == b''
+    assert cmd.message_payload.decode('utf-16-be') == u'буу' * 100
+    assert cmd.data_coding == 8
+
+    cmd, = decoded_submits(u'boo', mode='sar', packed=True)
+    assert gsm.unpack7(cmd.short_message, 3) == b'boo'
+    assert 'sar_msg_ref_num' not in cmd
+
+    with pytest.raises(ValueError):
+        gsm.make_submits(u'boo', mode='SAR')
@@ -1,4 +1,6 @@
-from smpipi.packet import (NString, int8, int16, int32, String,
+import pytest
+
+from smpipi.packet import (NString, int8, int16, int32, String, DecodeError,
                            Packet, SizeField, Field, Array, DispatchField)
 
 
@@ -13,6 +15,9 @@ def test_nstring():
 
     assert NString(max=10).encode('boo') == b'boo\x00'
 
+    with pytest.raises(DecodeError):
+        NString(max=3).decode(buf, 0)
+
 
 def test_string():
     buf = b'1233456'
@@ -85,3 +90,64 @@ def test_dispatch():
     payload = Body.encode({'flag': 2, 'boo': 'foobar'})
     data, _ = Body.decode(payload)
     assert data == {'flag': 2, 'boo': b'foobar'}
+
+
+def test_integer_run():
+    class Body(Packet):
+        boo = Field(int8)
+        foo = Field(int16)
+        bar = Field(NString(max=10))
+        baz = Field(int32)
+
+    boo_foo, bar, baz = Body.steps
+    assert boo_foo.names == ('boo', 'foo')
+    assert baz is Body.baz
+
+    payload = Body.encode({'boo': 1, 'foo': '300', 'bar': 'bar'})
+    assert payload == b'\x01\x01\x2cbar\x00\x00\x00\x00\x00'
+
+    data, offset = Body.decode(payload)
+    assert data == {'boo': 1, 'foo': 300, 'bar': b'bar', 'baz': 0}
+    assert offset == len(payload)
+
+
+def test_encode_into():
+    class Item(Packet):
+        flag = DispatchField(int8, {1: type('Bar', (Packet,), {'bar': Field(int16)})})
+
+    class Body(Packet):
+        boo = Field(int8)
+        foo = Field(NString(max=10))
+        items = SizeField(Field(int8, 'items_len'), Array(Item))
+        bar = SizeField(Field(int16, 'bar_len'), String(max=10))
+
+    data = {'boo': 1, 'foo': 'foo', 'items': [{'flag': 1, 'bar': 2}], 'bar': 'bar'}
+    buf = bytearray(b'xx')
+    assert Body.encode_into(buf, data) is buf
+    assert buf == b'xx\x01foo\x00\x01\x01\x00\x02\x00\x03bar'
+    assert data['items_len'] == 1
+    assert data['bar_len'] == 3
+    assert Body.encode({}) == b'\x00\x00\x00\x00\x00'
+
+
+def test_encode_values():
+    class Bar(Packet):
+        bar = Field(int16)
+
+    assert int8.encode(None) == b'\x00'
+    assert NString(max=10).encode(None) == b'\x00'
+    assert String(max=10).encode('boo') == (b'boo', 3)
+    assert String(max=10).encode(None) == (b'', 0)
+    assert Array(Bar).encode([{'bar': 1}, {'bar': 2}]) == (b'\x00\x01\x00\x02', 2)
+    assert Array(Bar).encode(None) == (b'', 0)
+
+    class Body(Packet):
+        foo = Field(NString(max=10))
+        boo = SizeField(Field(int8, 'boo_len'), String(max=10))
+        flag = DispatchField(int8, {1: Bar})
+
+    ctx = {'foo': 'foo', 'boo': 'bar', 'flag': 1, 'bar': 5}
+    assert Body.foo.encode(ctx) == b'foo\x00'
+    assert Body.boo.encode(ctx) == b'\x03bar'
+    assert ctx['boo_len'] == 3
+    assert Body.flag.encode(ctx) == b'\x01\x00\x05'
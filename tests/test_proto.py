@@ -1,8 +1,9 @@
 import time
 import pytest
 
-from smpipi import command
-from smpipi.proto import Proto, BaseESME, BrokenLink
+from smpipi import command, gsm, tlv
+from smpipi.proto import (Proto, BaseESME, BasePool, BrokenLink, ReceiveBuffer,
+                          Throttle)
 
 
 def test_simple_receive():
@@ -30,14 +31,50 @@ def test_multiple_commands():
     assert cmd2.short_message == b'foo'
 
 
+def test_lazy_receive():
+    proto = Proto(lazy=True)
+    data = proto.send_bytes(command.SubmitSM(short_message='boo'))
+    cmd, = list(proto.receive_bytes(data))
+    assert cmd._pending
+    assert cmd.short_message == b'boo'
+    assert not cmd._pending
+
+    for check in (lambda c: 'short_message' in c, lambda c: c.get('short_message'),
+                  lambda c: 'short_message' in list(c), lambda c: dict(c.items()),
+                  lambda c: list(c.keys()), lambda c: list(c.values()),
+                  lambda c: c == command.Command.decode(bytes(data))):
+        cmd, = list(proto.receive_bytes(data))
+        assert check(cmd)
+        assert not cmd._pending
+        assert cmd['short_message'] == b'boo'
+
+
+def test_burst_receive():
+    proto = Proto()
+    proto.compact_size = 100
+    data = proto.send_bytes(*[command.SubmitSM(short_message=str(i))
+                              for i in range(50)])
+    cmds = list(proto.receive_bytes(data + data[:20]))
+    assert [c.short_message for c in cmds] == [str(i).encode() for i in range(50)]
+    assert proto.offset == 0
+    assert len(proto.buffer) == 20
+
+    cmd, = list(proto.receive_bytes(data[20:cmds[0].command_length]))
+    assert cmd.short_message == b'0'
+    assert proto.offset == 0
+    assert not proto.buffer
+
+
 class TestESME(BaseESME):
     def __init__(self, *args, **kwargs):
         BaseESME.__init__(self, *args, **kwargs)
         self.commands_to_send = []
         self.delivered_commands = []
+        self.writes = 0
 
     def on_send(self, data):
-        self.commands_to_send.append(command.Command.decode(data))
+        self.writes += 1
+        self.commands_to_send.extend(Proto().receive_bytes(data))
 
     def on_close(self):
         self.closed = True
@@ -107,6 +144,7 @@ def test_deliver():
 def test_deliver_with_post_handler():
     def on_deliver(req, resp, reply):
         reply()
+        esme.flush()
         assert esme.commands_to_send[-1].command_id == command.DeliverSMResp.command_id
 
     esme = TestESME()
@@ -142,3 +180,355 @@ def test_ping():
     esme.enquire_response.expire = now
     with pytest.raises(BrokenLink):
         esme.ping()
+
+
+def test_pipeline():
+    esme = TestESME()
+    results = []
+    messages = [{'short_message': str(i)} for i in range(5)]
+    pipeline = esme.pipeline(messages, 2, lambda req, resp: results.append(req))
+
+    assert esme.writes == 1
+    assert [c.sequence_number for c in esme.commands_to_send] == [1, 2]
+
+    esme.feed_cmd(command.SubmitSMResp(sequence_number=2))
+    assert [c.sequence_number for c in esme.commands_to_send] == [1, 2, 3]
+    assert pipeline.in_flight == 2
+
+    esme.feed_cmd(*[command.SubmitSMResp(sequence_number=i) for i in (1, 3, 4, 5)])
+    assert pipeline.done
+    assert [r.short_message for r in results] == ['1', '0', '2', '3', '4']
+    assert [(req.sequence_number, resp.sequence_number)
+            for req, resp in pipeline.results] == [(2, 2), (1, 1), (3, 3), (4, 4), (5, 5)]
+
+
+def test_batched_writes():
+    esme = TestESME(flush_pdus=3)
+    data = b''.join(command.DeliverSM(sequence_number=i).encode() for i in range(5))
+    esme.feed(data + command.EnquireLink(sequence_number=5).encode())
+    assert esme.writes == 2
+    assert [c.sequence_number for c in esme.commands_to_send] == list(range(6))
+
+    esme = TestESME(flush_bytes=1)
+    esme.feed(data)
+    assert esme.writes == 5
+
+    esme = TestESME()
+    with esme.batch():
+        esme.send_message(short_message='boo')
+        with esme.batch():
+            esme.send_message(short_message='foo')
+        assert not esme.writes
+    assert esme.writes == 1
+    assert len(esme.commands_to_send) == 2
+
+
+def test_failed_encode():
+    esme = TestESME()
+    with pytest.raises(Exception):
+        with esme.batch():
+            esme.send_message(short_message='boo')
+            esme.send_message(short_message='x' * 300)
+    assert [c.sequence_number for c in esme.commands_to_send] == [1]
+    assert list(esme.in_flight) == [1]
+
+    buf = bytearray(b'data')
+    with pytest.raises(Exception):
+        command.SubmitSM(short_message='x' * 300).encode_into(buf)
+    assert buf == b'data'
+
+    template = command.SubmitSM.template(('short_message',), source_addr='boo')
+    with pytest.raises(Exception):
+        template.make(short_message='x' * 300).encode_into(buf)
+    assert buf == b'data'
+
+    esme = TestESME()
+    with pytest.raises(Exception):
+        esme.send_many([command.SubmitSM(short_message=m) for m in ('boo', 'x' * 300, 'foo')])
+    assert [c.sequence_number for c in esme.commands_to_send] == [1]
+    assert list(esme.in_flight) == [1]
+
+
+def test_request_timeout():
+    esme = TestESME(response_timeout=10)
+    expired = []
+    resp1 = esme.send(command.EnquireLink(), on_timeout=expired.append)
+    resp2 = esme.send(command.EnquireLink(), timeout=30)
+    resp3 = esme.send(command.EnquireLink())
+    esme.feed_cmd(command.EnquireLinkResp(sequence_number=3))
+
+    esme.expire_requests(time.time() + 20)
+    assert expired == [resp1]
+    assert resp1.timed_out
+    assert not resp2.timed_out
+    assert not resp3.timed_out
+    assert list(esme.in_flight) == [2]
+
+    esme.feed_cmd(command.EnquireLinkResp(sequence_number=1))
+    assert not resp1.ready
+
+    esme.expire_requests(time.time() + 40)
+    assert resp2.timed_out
+    assert not esme.in_flight
+    assert not esme.deadlines
+
+    with pytest.warns(DeprecationWarning):
+        esme = TestESME(response_queue_size=1000)
+    assert esme.response_timeout == 60
+
+
+def test_deadlines_compaction():
+    esme = TestESME()
+    for i in range(1, 200):
+        esme.send(command.EnquireLink())
+        esme.feed_cmd(command.EnquireLinkResp(sequence_number=i))
+    assert len(esme.deadlines) < 100
+
+
+def test_pipeline_timeout():
+    esme = TestESME(response_timeout=10)
+    pipeline = esme.pipeline([{'short_message': 'boo'}], 2)
+    esme.expire_requests(time.time() + 20)
+    assert pipeline.done
+    (req, resp), = pipeline.results
+    assert req.short_message == 'boo'
+    assert resp is None
+
+
+def test_receive_buffer():
+    rb = ReceiveBuffer(10)
+    rb.get_buffer()[:4] = b'boo!'
+    assert rb.received(4) == b'boo!'
+    assert rb.received(10) == b'boo!' + b'\x00' * 6
+    assert rb.size == 10
+
+    rb = ReceiveBuffer(10, 35)
+    sizes = []
+    for nbytes in (10, 20, 35, 5, 4, 0):
+        sizes.append(len(rb.get_buffer()))
+        rb.received(nbytes)
+    assert sizes == [10, 20, 35, 35, 17, 10]
+    assert rb.size == 10
+
+
+def test_feed_view():
+    esme = TestESME()
+    rb = esme.receiver
+    data = command.DeliverSM(short_message='boo').encode()
+    rb.get_buffer()[:len(data)] = data
+    esme.feed(rb.received(len(data)))
+    req, = esme.delivered_commands
+    assert req.short_message == b'boo'
+
+
+def test_pool_pick():
+    pool = BasePool(window=2)
+    assert pool.pick() is None
+
+    esme1, esme2 = TestESME(), TestESME()
+    pool.add(esme1)
+    pool.add(esme2)
+    assert pool.pick() is esme1
+
+    esme1.send_message(short_message='boo')
+    assert pool.pick() is esme2
+    esme2.send_message(short_message='boo')
+    esme2.send_message(short_message='boo')
+    assert pool.pick() is esme1
+    esme1.send_message(short_message='boo')
+    assert pool.pick() is None
+
+    delivered = []
+    pool.on_deliver = lambda req, resp, reply: delivered.append(req)
+    esme2.feed_cmd(command.DeliverSM(short_message='foo'))
+    assert delivered[0].short_message == b'foo'
+
+    pool.remove(esme1)
+    pool.remove(esme1)
+    assert pool.connections == [esme2]
+
+
+def test_pool_pick_throttled():
+    pool = BasePool(window=2)
+    throttled, idle = TestESME(tps=1, burst=1), TestESME()
+    pool.add(throttled)
+    pool.add(idle)
+    throttled.send_message(short_message='boo')
+    throttled.send_message(short_message='boo')
+    assert len(throttled.in_flight) == 1
+    assert pool.pick() is idle
+    idle.send_message(short_message='boo')
+    idle.send_message(short_message='boo')
+    assert pool.pick() is None
+
+
+def test_throttle():
+    throttle = Throttle(10, 2)
+    now = throttle.updated
+    assert throttle.take(now) == 0
+    assert throttle.take(now) == 0
+    assert abs(throttle.take(now) - 0.1) < 1e-6
+    assert throttle.take(now + 0.11) == 0
+
+    throttle.backoff(now + 0.11)
+    assert throttle.rate == 5
+    assert throttle.take(now + 0.2) > 0
+    throttle.recover()
+    assert throttle.rate == 5.2
+    for _ in range(100):
+        throttle.recover()
+    assert throttle.rate == 10
+
+    for _ in range(10):
+        throttle.backoff()
+    assert throttle.rate == 0.5
+
+
+def test_throttled_send():
+    class ThrottledESME(TestESME):
+        def on_throttle(self, delay):
+            self.delays.append(delay)
+
+    esme = ThrottledESME(tps=10, burst=2)
+    esme.delays = []
+    for i in range(4):
+        esme.send_message(short_message=str(i))
+    esme.send(command.EnquireLink())
+    assert [c.sequence_number for c in esme.commands_to_send] == [1, 2, 5]
+    assert len(esme.throttled) == 2
+    assert esme.delays
+
+    esme.feed_cmd(command.SubmitSMResp(sequence_number=1,
+                                       command_status=command.ESME_RTHROTTLED))
+    assert esme.throttle.rate == 5
+    esme.throttle.updated -= 1
+    esme.release()
+    assert [c.sequence_number for c in esme.commands_to_send] == [1, 2, 5, 3, 4]
+
+    esme.feed_cmd(command.SubmitSMResp(sequence_number=2))
+    assert esme.throttle.rate == 5.2
+
+    esme.throttle.updated -= 1
+    esme.pipeline([{'short_message': 'boo'}] * 3, 3)
+    assert esme.commands_to_send[-1].sequence_number == 7
+    assert len(esme.throttled) == 1
+
+
+def test_reassemble_deliver():
+    esme = TestESME(reassemble=True)
+    parts, encoding, esm_class = gsm.make_parts(u'boo' * 100)
+    esme.feed_cmd(*[command.DeliverSM(sequence_number=i, short_message=p,
+                                      esm_class=esm_class)
+                    for i, p in enumerate(parts, 1)])
+    assert [c.sequence_number for c in esme.commands_to_send] == [1, 2]
+    req, = esme.delivered_commands
+    assert req.text == u'boo' * 100
+
+
+def test_compact_commands():
+    esme = TestESME(compact=True)
+    resp = esme.send_message(short_message='boo')
+    esme.feed_cmd(command.SubmitSMResp(sequence_number=1, message_id='id'),
+                  command.DeliverSM(sequence_number=42, short_message='boo'))
+    assert resp.response.message_id == b'id'
+
+    req, = esme.delivered_commands
+    assert type(req) is command.DeliverSM.compact_type()
+    assert req.short_message == b'boo'
+    assert esme.commands_to_send[-1].command_id == command.DeliverSMResp.command_id
+
+
+def test_tlv_registry():
+    registry = tlv.Registry({0x1401: tlv.StrField('vendor_ref')})
+    proto = Proto(tlv_registry=registry)
+    data = proto.send_bytes(command.DeliverSM(vendor_ref='abc'))
+    cmd, = list(proto.receive_bytes(data))
+    assert cmd.vendor_ref == b'abc'
+
+
+def test_invalid_command_length():
+    proto = Proto(max_pdu_size=1024)
+    header = command.header_struct.pack(0xFFFFFFF0, 4, 0, 7)
+    assert not list(proto.receive_bytes(header[:10]))
+    error, = list(proto.receive_bytes(header[10:]))
+    assert error.fatal
+    assert error.command_status == command.ESME_RINVCMDLEN
+    assert error.sequence_number == 7
+    assert not proto.buffer
+    assert not list(proto.receive_bytes(command.EnquireLink().encode()))
+
+    esme = TestESME()
+    esme.closed = False
+    resp = esme.send(command.EnquireLink())
+    esme.feed(command.EnquireLinkResp(sequence_number=1).encode()
+              + command.header_struct.pack(8, 4, 0, 2) + b'\x00' * 32)
+    assert resp.ready
+    assert esme.closed
+    _, nack = esme.commands_to_send
+    assert type(nack) is command.GenericNack
+    assert nack.command_status == command.ESME_RINVCMDLEN
+    assert nack.sequence_number == 2
+
+
+def test_generic_nack_resolves_request():
+    esme = TestESME()
+    resp = esme.send_message(short_message='boo')
+    esme.feed_cmd(command.GenericNack(sequence_number=1, command_status=3))
+    assert resp.response.command_status == 3
+    assert not esme.in_flight
+
+
+def test_decode_errors():
+    esme = TestESME()
+    esme.closed = False
+    deliver = command.DeliverSM(sequence_number=5, short_message='boo').encode()
+    unknown = command.header_struct.pack(16, 0x42, 0, 2)
+    unterminated = command.header_struct.pack(20, 4, 0, 3) + b'boo!'
+    bad_tlv = command.header_struct.pack(len(deliver) + 5, 5, 0, 4)
+    bad_tlv += deliver[16:] + b'\x00\x05\x00\x09\x01'
+    esme.feed(unknown + unterminated + bad_tlv + deliver)
+
+    assert not esme.closed
+    req, = esme.delivered_commands
+    assert req.sequence_number == 5
+    statuses = [(c.command_id, c.sequence_number, c.command_status)
+                for c in esme.commands_to_send]
+    nack = command.GenericNack.command_id
+    assert statuses == [(nack, 2, command.ESME_RINVCMDID),
+                        (nack, 3, command.ESME_RINVCMDLEN),
+                        (nack, 4, command.ESME_RINVOPTPARSTREAM),
+                        (command.DeliverSMResp.command_id, 5, 0)]
+
+
+def test_lazy_decode_errors():
+    esme = TestESME(lazy=True)
+    esme.on_deliver = lambda req, resp, reply: esme.delivered_commands.append(
+        req.short_message)
+    unterminated = command.header_struct.pack(20, 4, 0, 3) + b'boo!'
+    deliver = command.DeliverSM(sequence_number=5, short_message='boo').encode()
+    esme.feed(unterminated + deliver)
+
+    assert esme.delivered_commands == [b'boo']
+    statuses = [(c.command_id, c.sequence_number, c.command_status)
+                for c in esme.commands_to_send]
+    assert statuses == [(command.GenericNack.command_id, 3, command.ESME_RINVCMDLEN),
+                        (command.DeliverSMResp.command_id, 5, 0)]
+
+
+def test_throttled_deadline():
+    esme = TestESME(tps=1, burst=1, response_timeout=10)
+    expired = []
+    resps = [esme.send_message(short_message=str(i), callback=None)
+             for i in range(3)]
+    for resp in resps:
+        resp.on_timeout = expired.append
+    assert list(esme.in_flight) == [1]
+
+    esme.expire_requests(time.time() + 20)
+    assert expired == [resps[0]]
+    assert len(esme.throttled) == 2
+
+    esme.throttle.updated -= 1
+    esme.release()
+    assert list(esme.in_flight) == [2]
+    assert esme.in_flight[2].expire > time.time() + 5
@@ -1,3 +1,5 @@
+import time
+
 import pytest
 
 from smpipi.simple import ESME, Timeout
@@ -57,3 +59,37 @@ def test_timeout(smsc):
     with pytest.raises(Timeout):
         esme.wait_for(resp, 1)
     assert not resp.ready
+
+
+def test_submit_many(smsc):
+    esme = ESME('127.0.0.1', 30001)
+    messages = [{'short_message': 'boo'} for _ in range(20)]
+    results = list(esme.submit_many(messages, 5, 10))
+    assert len(results) == 20
+    assert all(resp.command_status == 0 for _, resp in results)
+
+    with pytest.raises(Timeout):
+        list(esme.submit_many([{'short_message': 'sleep'}] * 2, 1, 0.5))
+
+
+def test_request_inside_deliver(smsc):
+    esme = ESME('127.0.0.1', 30001)
+    results = []
+
+    def on_deliver(req, resp, reply):
+        results.append(esme.wait_for(esme.send_message(short_message='boo'), 5))
+
+    esme.on_deliver = on_deliver
+    esme.wait_for(esme.send_message(short_message='deliver foo'), 5)
+    while not results:
+        esme.read()
+    assert results[0].command_status == 0
+
+
+def test_throttle(smsc):
+    esme = ESME('127.0.0.1', 30001, tps=20, burst=1)
+    start = time.time()
+    resps = [esme.send_message(short_message='boo') for _ in range(3)]
+    assert not esme.throttled
+    assert all(esme.wait_for(resp, 5).command_status == 0 for resp in resps)
+    assert time.time() - start >= 0.09
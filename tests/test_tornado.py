@@ -1,7 +1,12 @@
-from tornado.gen import coroutine
+import socket
+import time
+
+from tornado.gen import coroutine, multi, sleep
 from tornado.ioloop import IOLoop
 
-from smpipi.tornado import ESME
+from smpipi import command
+from smpipi.proto import Proto
+from smpipi.tornado import ESME, ESMEPool
 
 
 def async_run(func):
@@ -38,3 +43,87 @@ def test_delivery(smsc):
         yield esme.connect('127.0.0.1', 30001)
         esme.send_message(short_message='deliver foo')
         yield esme.run()
+
+
+def test_throttle(smsc):
+    @async_run
+    def work():
+        esme = ESME(tps=20, burst=1)
+        yield esme.connect('127.0.0.1', 30001)
+        start = time.time()
+        resps = [esme.send_message(short_message='boo') for _ in range(3)]
+        assert len(esme.throttled) == 2
+        for resp in resps:
+            assert (yield esme.wait_for(resp)).command_status == 0
+        assert time.time() - start >= 0.09
+        assert not esme.throttled
+
+
+def test_pool(smsc):
+    @async_run
+    def work():
+        pool = ESMEPool('127.0.0.1', 30001, 'boo', 'foo', size=3, window=2)
+        pool.start()
+        results = yield multi([pool.submit(short_message='boo') for _ in range(20)])
+        assert all(resp.command_status == 0 for resp in results)
+        assert len(pool.connections) == 3
+        connections = list(pool.connections)
+        yield pool.stop()
+        assert all(esme.closed for esme in connections)
+        resp = yield pool.submit(short_message='boo')
+        assert resp is None
+
+
+def test_pool_reconnect():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+
+    @async_run
+    def work():
+        pool = ESMEPool('127.0.0.1', port, 'boo', 'foo', size=2, reconnect_delay=0.01)
+        pool.start()
+        yield sleep(0.05)
+        assert not pool.connections
+        yield pool.stop()
+
+
+def test_timeout(smsc):
+    @async_run
+    def work():
+        esme = ESME(response_timeout=0.3)
+        esme.tick_interval = 0.1
+        yield esme.connect('127.0.0.1', 30001)
+        yield esme.wait_for(esme.send_message(short_message='sleep'))
+
+        resp = esme.send_message(short_message='boo')
+        assert (yield esme.wait_for(resp)) is None
+        assert resp.timed_out
+
+        esme.response_timeout = 10
+        resp = yield esme.wait_for(esme.send_message(short_message='close'))
+        assert resp.command_status == 0
+        yield esme.run()
+
+
+def test_lazy_deliver_decode_error():
+    @async_run
+    def work():
+        sent = []
+        esme = ESME(lazy=True)
+        esme.ioloop = IOLoop.current()
+        esme.stream = type('Stream', (), {'write': lambda self, data: sent.append(data)})()
+
+        @coroutine
+        def on_deliver(req, resp, reply):
+            assert req.short_message
+
+        esme.on_deliver = on_deliver
+        bad = command.header_struct.pack(20, command.DeliverSM.command_id, 0, 3)
+        esme.feed(bad + b'boo!')
+        yield sleep(0.01)
+
+        nack, = Proto().receive_bytes(b''.join(map(bytes, sent)))
+        assert type(nack) is command.GenericNack
+        assert nack.command_status == command.ESME_RINVCMDLEN